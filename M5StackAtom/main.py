@@ -79,7 +79,8 @@ def scan_rfid_once(rdr):
 
 def send_card(card_id):
     print("[SEND] Sender kort-ID til backend:", card_id)
-    data = {"card_id": card_id, "device_id": DEVICE_ID}
+    # async: backend svarer 202 straks og spiller i bakgrunnen, så vi kan sove igjen
+    data = {"card_id": card_id, "device_id": DEVICE_ID, "async": True}
     try:
         r = urequests.post(SERVER_URL + "/play_by_card", json=data)
         print("[SEND] Svar:", r.json())
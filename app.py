@@ -1,14 +1,30 @@
 from flask import Flask, request, jsonify
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import xml.sax.saxutils as saxutils
 import re
 import xml.etree.ElementTree as ET
 import urllib.parse
 import os
+import sys
+import tempfile
+import atexit
+import signal
+import sqlite3
 from soco import SoCo, discover
+from soco.exceptions import SoCoUPnPException
 from soco.plugins.sharelink import ShareLinkPlugin
 import threading
+import itertools
+import time
+import socket
+import ssl
+import hashlib
+import secrets
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 
 app = Flask(__name__)
 
@@ -68,35 +84,651 @@ def require_auth_or_local(fn):
     return wrapper
 # --------------------------
 
+# --------------------------
+# UTGÅENDE HTTP: én delt klient med connection pool per host, standard
+# timeout, begrensede retries med backoff og latens/feil-tellere per host.
+# --------------------------
+HTTP_DEFAULT_TIMEOUT = (3.05, 10)  # (connect, read)
+HTTP_POOL_SIZE = 16
+
+def _make_http_session(retries=True):
+    retry = Retry(
+        total=2,
+        read=1,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        raise_on_status=False,
+    ) if retries else 0
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+http_session = _make_http_session()
+# Strømprober uten retries: en retry åpner en ny tilkobling til en radiostrøm
+# (og et "ICY 200 OK"-svar regnes som lesefeil og ville blitt prøvd på nytt)
+probe_session = _make_http_session(retries=False)
+_http_stats = {}
+_http_stats_lock = threading.Lock()
+
+def _http_record(host, elapsed_ms, error):
+    with _http_stats_lock:
+        st = _http_stats.setdefault(host, {"requests": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+        st["requests"] += 1
+        st["errors"] += int(error)
+        st["total_ms"] += elapsed_ms
+        st["max_ms"] = max(st["max_ms"], elapsed_ms)
+
+def http_request(method, url, session=None, **kwargs):
+    kwargs.setdefault("timeout", HTTP_DEFAULT_TIMEOUT)
+    host = urllib.parse.urlsplit(url).hostname or ""
+    t0 = time.monotonic()
+    try:
+        response = (session or http_session).request(method, url, **kwargs)
+    except Exception:
+        _http_record(host, (time.monotonic() - t0) * 1000, True)
+        raise
+    _http_record(host, (time.monotonic() - t0) * 1000, response.status_code >= 500)
+    return response
+
+def http_get(url, **kwargs):
+    return http_request("GET", url, **kwargs)
+
+def http_stats():
+    with _http_stats_lock:
+        return {
+            host: {
+                "requests": st["requests"],
+                "errors": st["errors"],
+                "avg_ms": round(st["total_ms"] / st["requests"], 1) if st["requests"] else None,
+                "max_ms": round(st["max_ms"], 1),
+            }
+            for host, st in _http_stats.items()
+        }
+
 
 # Katalogen der lokale podcast XML-filer ligger
 PODCAST_FEED_DIR = "/home/palchrb/NRK_P/nrk-pod-feeds/docs/rss"
 
-# Fil for lagring av mapping (device_id --> høyttaler-IP)
-DEVICE_MAPPING_FILE = "device_mapping.json"
-mapping_lock = threading.Lock()
+def _atomic_write_json(path, data, **dump_kwargs):
+    """Skriv til temp-fil i samme katalog, fsync og rename – filen er aldri halvskrevet."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".json", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, **dump_kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
 
-def load_mapping():
+# --------------------------
+# STATE-LAGER (SQLite i WAL-modus)
+# Kortmappinger, device-mappinger og historikk over ukjente kort i én fil.
+# rfid_mappings.json, device_mapping.json og last_unmapped_rfid.txt
+# importeres automatisk første gang (og på nytt via POST /state/import).
+# --------------------------
+STATE_DB_FILE = os.environ.get("SOCORFID_STATE_DB", "state.db")
+RFID_MAPPING_FILE = "rfid_mappings.json"
+LAST_UNMAPPED_FILE = "last_unmapped_rfid.txt"
+
+_STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS card_mappings (
+    card_id    TEXT PRIMARY KEY,
+    type       TEXT NOT NULL,
+    media      TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS device_mappings (
+    device_id  TEXT PRIMARY KEY,
+    ip         TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS unmapped_scans (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    card_id    TEXT NOT NULL,
+    device_id  TEXT,
+    scanned_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_unmapped_scans_card ON unmapped_scans(card_id);
+CREATE INDEX IF NOT EXISTS idx_unmapped_scans_time ON unmapped_scans(scanned_at);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS nrk_episode_chain (
+    program_id      TEXT PRIMARY KEY,
+    next_program_id TEXT,
+    title           TEXT NOT NULL,
+    duration        TEXT NOT NULL,
+    album_art       TEXT NOT NULL,
+    updated_at      REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS nrk_episode_titles (
+    episode_id    TEXT PRIMARY KEY,
+    slug          TEXT NOT NULL,
+    title         TEXT NOT NULL,
+    enclosure_url TEXT NOT NULL,
+    duration      TEXT NOT NULL,
+    album_art     TEXT NOT NULL,
+    resolved_at   REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS nrk_metadata_cache (
+    program_id    TEXT PRIMARY KEY,
+    body          TEXT NOT NULL,
+    etag          TEXT,
+    last_modified TEXT,
+    fetched_at    REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS card_playlists (
+    card_id     TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    playlist_id TEXT NOT NULL,
+    title       TEXT NOT NULL,
+    signature   TEXT NOT NULL,
+    items       INTEGER NOT NULL,
+    built_at    REAL NOT NULL,
+    checked_at  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS owned_playlists (
+    playlist_id TEXT PRIMARY KEY,
+    title       TEXT NOT NULL,
+    created_at  REAL NOT NULL
+);
+INSERT OR IGNORE INTO owned_playlists (playlist_id, title, created_at)
+    SELECT playlist_id, title, built_at FROM card_playlists;
+"""
+
+_db_local = threading.local()
+_db_init_lock = threading.Lock()
+_db_initialized = False
+
+def _connect_db():
+    conn = sqlite3.connect(STATE_DB_FILE, timeout=10)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=10000")
+    return conn
+
+def _db():
+    """Én tilkobling per tråd; skjema + engangsimport kjøres første gang."""
+    global _db_initialized
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = _db_local.conn = _connect_db()
+    if not _db_initialized:
+        with _db_init_lock:
+            if not _db_initialized:
+                conn.executescript(_STATE_SCHEMA)
+                if conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone() is None:
+                    _import_json_state(conn)
+                _db_initialized = True
+    return conn
+
+def _read_json_file(path):
     try:
-        with open(DEVICE_MAPPING_FILE, "r") as f:
+        with open(path, "r") as f:
             return json.load(f)
     except FileNotFoundError:
         return {}
 
+def _import_json_state(conn, overwrite=False):
+    """Importer de gamle JSON/txt-filene. overwrite=False beholder eksisterende rader."""
+    now = time.time()
+    verb = "INSERT OR REPLACE" if overwrite else "INSERT OR IGNORE"
+    devices = _read_json_file(DEVICE_MAPPING_FILE)
+    device_rows = [(device_id, ip, now) for device_id, ip in devices.items() if ip]
+    last_unmapped = None
+    try:
+        with open(LAST_UNMAPPED_FILE, "r") as f:
+            last_unmapped = f.read().strip() or None
+    except FileNotFoundError:
+        pass
+    with conn:
+        card_count = _import_card_file(conn, overwrite)
+        conn.executemany(f"{verb} INTO device_mappings (device_id, ip, updated_at) VALUES (?, ?, ?)", device_rows)
+        if last_unmapped and conn.execute(
+                "SELECT 1 FROM unmapped_scans WHERE card_id = ?", (last_unmapped,)).fetchone() is None:
+            conn.execute("INSERT INTO unmapped_scans (card_id, device_id, scanned_at) VALUES (?, NULL, ?)",
+                         (last_unmapped, now))
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_imported', ?)", (str(now),))
+    return {"cards": card_count, "devices": len(device_rows), "last_unmapped": last_unmapped}
+
+def _rfid_file_mtime():
+    try:
+        return str(os.stat(RFID_MAPPING_FILE).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+def _card_entry_hash(mapping_type, media):
+    return hashlib.sha1(json.dumps([mapping_type, media]).encode("utf-8")).hexdigest()
+
+def _bump_cards_version(conn):
+    """Tell opp card_mappings-versjonen; kortindeksen lastes på nytt bare når den endres."""
+    conn.execute(
+        "INSERT INTO meta (key, value) VALUES ('cards_version', '1') "
+        "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+    )
+
+def _import_card_file(conn, overwrite, changed_only=False):
+    """
+    Upsert kortene fra rfid_mappings.json og husk filens mtime og en hash
+    per oppføring. changed_only=True tar bare med oppføringer som er nye
+    eller endret i filen siden forrige import, så mappinger lagt inn via
+    /add_mapping ikke overskrives av en urørt JSON-linje. Kalles i en transaksjon.
+    """
+    mtime = _rfid_file_mtime()
+    verb = "INSERT OR REPLACE" if overwrite or changed_only else "INSERT OR IGNORE"
+    now = time.time()
+    cards = _read_json_file(RFID_MAPPING_FILE)
+    row = conn.execute("SELECT value FROM meta WHERE key = 'rfid_json_hashes'").fetchone()
+    seen = json.loads(row["value"]) if row else {}
+    hashes = {}
+    rows = []
+    for card_id, m in cards.items():
+        if not (isinstance(m, dict) and m.get("type") and m.get("media")):
+            continue
+        hashes[card_id] = _card_entry_hash(m["type"], m["media"])
+        if changed_only and seen.get(card_id) == hashes[card_id]:
+            continue
+        rows.append((card_id, m["type"], m["media"], now))
+    if rows:
+        conn.executemany(f"{verb} INTO card_mappings (card_id, type, media, updated_at) VALUES (?, ?, ?, ?)", rows)
+        _bump_cards_version(conn)
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rfid_json_hashes', ?)", (json.dumps(hashes),))
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rfid_json_mtime', ?)", (mtime,))
+    return len(rows)
+
+def import_json_state(overwrite=False):
+    return _import_json_state(_db(), overwrite=overwrite)
+
+# Kortindeks i minnet: hele card_mappings som dict, lastet på nytt når
+# cards_version i meta endres (telles opp ved hver skriving til kortene)
+# eller når rfid_mappings.json er redigert for hånd (mtime endret -> de
+# endrede oppføringene importeres).
+_card_index = None
+_card_index_lock = threading.Lock()
+_card_index_stats = {
+    "reloads": 0,
+    "loaded_at": None,
+    "load_ms": None,
+    "json_imports": 0,
+    "version": None,
+    "json_mtime": None,
+}
+
+def _cards_version():
+    row = _db().execute("SELECT value FROM meta WHERE key = 'cards_version'").fetchone()
+    return row["value"] if row else None
+
+def _sync_rfid_file():
+    """Importer nye/endrede oppføringer fra rfid_mappings.json hvis mtime er endret siden sist."""
+    mtime = _rfid_file_mtime()
+    if mtime is None or mtime == _card_index_stats["json_mtime"]:
+        return
+    conn = _db()
+    row = conn.execute("SELECT value FROM meta WHERE key = 'rfid_json_mtime'").fetchone()
+    if row is None or row["value"] != mtime:
+        with conn:
+            _import_card_file(conn, overwrite=False, changed_only=True)
+        _card_index_stats["json_imports"] += 1
+    _card_index_stats["json_mtime"] = mtime
+
+def _current_card_index():
+    global _card_index
+    _db()
+    _sync_rfid_file()
+    if _card_index is not None and _cards_version() == _card_index_stats["version"]:
+        return _card_index
+    with _card_index_lock:
+        version = _cards_version()  # før SELECT, så en samtidig skriving ikke går tapt
+        if _card_index is None or version != _card_index_stats["version"]:
+            t0 = time.monotonic()
+            _card_index = db_all_cards()
+            _card_index_stats.update({
+                "reloads": _card_index_stats["reloads"] + 1,
+                "loaded_at": time.time(),
+                "load_ms": round((time.monotonic() - t0) * 1000, 2),
+                "version": version,
+            })
+        return _card_index
+
+def get_card(card_id):
+    return _current_card_index().get(card_id)
+
+def all_cards():
+    return dict(_current_card_index())
+
+def card_index_stats():
+    idx = _card_index
+    return {
+        "cards": len(idx) if idx is not None else None,
+        "reloads": _card_index_stats["reloads"],
+        "loaded_at": _card_index_stats["loaded_at"],
+        "load_ms": _card_index_stats["load_ms"],
+        "json_imports": _card_index_stats["json_imports"],
+    }
+
+def db_all_cards():
+    rows = _db().execute("SELECT card_id, type, media FROM card_mappings ORDER BY rowid").fetchall()
+    return {r["card_id"]: {"type": r["type"], "media": r["media"]} for r in rows}
+
+def db_upsert_card(card_id, mapping_type, media):
+    with _db() as conn:
+        conn.execute(
+            "INSERT INTO card_mappings (card_id, type, media, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(card_id) DO UPDATE SET type = excluded.type, media = excluded.media, "
+            "updated_at = excluded.updated_at",
+            (card_id, mapping_type, media, time.time()),
+        )
+        _bump_cards_version(conn)
+
+def db_record_unmapped(card_id, device_id=None):
+    with _db() as conn:
+        conn.execute("INSERT INTO unmapped_scans (card_id, device_id, scanned_at) VALUES (?, ?, ?)",
+                     (card_id, device_id, time.time()))
+
+def db_last_unmapped():
+    """Siste skannede ukjente kort, eller "" hvis det har fått mapping siden."""
+    row = _db().execute(
+        "SELECT u.card_id, EXISTS (SELECT 1 FROM card_mappings c WHERE c.card_id = u.card_id) AS mapped "
+        "FROM unmapped_scans u ORDER BY u.id DESC LIMIT 1"
+    ).fetchone()
+    if not row or row["mapped"]:
+        return ""
+    return row["card_id"]
+
+def db_unmapped_history(limit=50):
+    rows = _db().execute(
+        "SELECT u.card_id, u.device_id, u.scanned_at, "
+        "EXISTS (SELECT 1 FROM card_mappings c WHERE c.card_id = u.card_id) AS mapped "
+        "FROM unmapped_scans u ORDER BY u.id DESC LIMIT ?", (limit,)
+    ).fetchall()
+    return [{**dict(r), "mapped": bool(r["mapped"])} for r in rows]
+
+def db_load_devices():
+    rows = _db().execute("SELECT device_id, ip FROM device_mappings").fetchall()
+    return {r["device_id"]: r["ip"] for r in rows}
+
+def db_upsert_devices(entries):
+    now = time.time()
+    with _db() as conn:
+        conn.executemany(
+            "INSERT INTO device_mappings (device_id, ip, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(device_id) DO UPDATE SET ip = excluded.ip, updated_at = excluded.updated_at",
+            [(device_id, ip, now) for device_id, ip in entries.items()],
+        )
+
+# Mapping device_id --> høyttaler-IP
+# Mappingen holdes i minnet; endrede rader skrives samlet til state-lageret
+# av en bakgrunnstråd (write-behind) og flushes ved nedstenging.
+DEVICE_MAPPING_FILE = "device_mapping.json"  # kun kilde for engangsimport
+MAPPING_FLUSH_DELAY = 1.0  # sekunder å samle opp endringer før skriving
+mapping_lock = threading.Lock()
+_mapping_flush_lock = threading.Lock()
+_device_mapping = None
+_mapping_dirty = set()
+_mapping_wakeup = threading.Event()
+_mapping_writer = None
+
+def _mapping():
+    """Mappingen i minnet (lastes fra lageret første gang). Kalles med mapping_lock."""
+    global _device_mapping
+    if _device_mapping is None:
+        _device_mapping = db_load_devices()
+    return _device_mapping
+
+def load_mapping():
+    with mapping_lock:
+        return dict(_mapping())
+
 def save_mapping(mapping):
-    with open(DEVICE_MAPPING_FILE, "w") as f:
-        json.dump(mapping, f)
+    db_upsert_devices(mapping)
+
+def flush_mapping():
+    """Skriv endrede device-mappinger til lageret nå."""
+    global _mapping_dirty
+    with _mapping_flush_lock:
+        with mapping_lock:
+            if not _mapping_dirty:
+                return
+            mapping = _mapping()
+            changed = {k: mapping[k] for k in _mapping_dirty}
+            _mapping_dirty = set()
+        try:
+            save_mapping(changed)
+        except Exception:
+            with mapping_lock:
+                _mapping_dirty |= changed.keys()
+            raise
+
+def _mapping_writer_worker():
+    while True:
+        _mapping_wakeup.wait()
+        time.sleep(MAPPING_FLUSH_DELAY)  # samle opp flere endringer i én skriving
+        _mapping_wakeup.clear()
+        try:
+            flush_mapping()
+        except Exception as e:
+            print("Feil ved lagring av device_mapping:", e)
 
 def set_speaker_for_device(device_id, ip):
+    global _mapping_writer
     with mapping_lock:
-        mapping = load_mapping()
+        mapping = _mapping()
+        if mapping.get(device_id) == ip:
+            return
         mapping[device_id] = ip
-        save_mapping(mapping)
+        _mapping_dirty.add(device_id)
+        if _mapping_writer is None:
+            _mapping_writer = threading.Thread(target=_mapping_writer_worker, name="mapping-writer", daemon=True)
+            _mapping_writer.start()
+    _mapping_wakeup.set()
 
 def get_speaker_for_device(device_id):
-    mapping = load_mapping()
+    mapping = _device_mapping
+    if mapping is None:
+        with mapping_lock:
+            mapping = _mapping()
     return mapping.get(device_id)
 
+atexit.register(flush_mapping)
+
+# --------------------------
+# HØYTTALER-HÅNDTAK: ett langlivet håndtak per høyttaler-IP med keep-alive
+# HTTP mot port 1400. Kontrollkommandoer (next/pause/...) går som ett direkte
+# SOAP-kall over håndtakets session, uten soco sin koordinator-sjekk først.
+# --------------------------
+SPEAKER_SOAP_TIMEOUT = (2, 10)  # (connect, read)
+SPEAKER_POOL_SIZE = 4
+
+_speaker_handles = {}  # ip -> {"soco", "session", "uid", "created", "last_used", "calls", "errors"}
+_speaker_handles_lock = threading.Lock()
+
+def _make_speaker_session():
+    # Ingen retries: SOAP-kall som Next er ikke idempotente
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SPEAKER_POOL_SIZE, max_retries=0)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    return session
+
+def _speaker_handle(ip):
+    with _speaker_handles_lock:
+        handle = _speaker_handles.get(ip)
+        if handle is None:
+            handle = {
+                "soco": SoCo(ip),
+                "session": _make_speaker_session(),
+                "uid": None,
+                "created": time.time(),
+                "last_used": None,
+                "calls": 0,
+                "errors": 0,
+                "state": None,
+                "state_at": 0.0,
+            }
+            _speaker_handles[ip] = handle
+        handle["last_used"] = time.time()
+        return handle
+
+def get_sonos(ip):
+    """Gjenbrukbar SoCo-instans for IP-en (opprettes ved første bruk)."""
+    return _speaker_handle(ip)["soco"]
+
+def speaker_soap(ip, service, action, args, timeout=SPEAKER_SOAP_TIMEOUT):
+    """
+    Ett SOAP-kall over håndtakets keep-alive session. service er navnet på
+    soco-tjenesten (f.eks. "avTransport"). Returnerer svarargumentene som dict.
+    """
+    handle = _speaker_handle(ip)
+    svc = getattr(handle["soco"], service)
+    headers, body = svc.build_command(action, args)
+    try:
+        response = handle["session"].post(
+            svc.base_url + svc.control_url,
+            headers=headers,
+            data=body.encode("utf-8"),
+            timeout=timeout,
+        )
+    except requests.exceptions.ConnectionError:
+        # Høyttaleren er borte eller har byttet IP; neste kall starter på nytt
+        evict_speaker(ip)
+        raise
+    with _speaker_handles_lock:
+        handle["calls"] += 1
+        handle["errors"] += int(response.status_code != 200)
+    if response.status_code == 500:
+        svc.handle_upnp_error(response.text)
+    response.raise_for_status()
+    return svc.unwrap_arguments(response.text)
+
+def _warm_speaker(ip):
+    try:
+        handle = _speaker_handle(ip)
+        # Åpner keep-alive-forbindelsen og lærer uid (for å oppdage IP-bytte)
+        speaker_soap(ip, "avTransport", "GetTransportInfo", [("InstanceID", 0)])
+        uid = handle["soco"].uid
+        with _speaker_handles_lock:
+            handle["uid"] = uid
+    except Exception as e:
+        print("Feil ved oppvarming av høyttaler", ip, ":", e)
+
+def warm_speaker(ip):
+    """Varm opp håndtaket i bakgrunnen, så første knappetrykk slipper TCP-oppsett."""
+    threading.Thread(target=_warm_speaker, args=(ip,), name=f"warm-{ip}", daemon=True).start()
+
+def evict_speaker(ip):
+    with _speaker_handles_lock:
+        handle = _speaker_handles.pop(ip, None)
+    if handle:
+        handle["session"].close()
+
+def prune_speaker_handles(ip_by_uid):
+    """
+    Kalles etter en topologioppdatering med {uid: ip} for alle kjente soner.
+    Håndtak for IP-er som er borte kastes; har en uid fått ny IP, flyttes
+    device-mappinger som pekte på den gamle IP-en.
+    """
+    live_ips = set(ip_by_uid.values())
+    uid_by_ip = {ip: uid for uid, ip in ip_by_uid.items()}
+    with _speaker_handles_lock:
+        for ip, h in _speaker_handles.items():
+            if h["uid"] is None and ip in uid_by_ip:
+                h["uid"] = uid_by_ip[ip]
+        known = {ip: h["uid"] for ip, h in _speaker_handles.items()}
+    moved = {}
+    for ip, uid in known.items():
+        new_ip = ip_by_uid.get(uid) if uid else None
+        if new_ip and new_ip != ip:
+            moved[ip] = new_ip
+        if ip not in live_ips or ip in moved:
+            evict_speaker(ip)
+    for device_id, ip in load_mapping().items():
+        if ip in moved:
+            print(f"Høyttaler flyttet fra {ip} til {moved[ip]}, oppdaterer {device_id}")
+            set_speaker_for_device(device_id, moved[ip])
+
+# Transport- og køtilstand per høyttaler, så forberedelse før avspilling kun
+# sender kallene som faktisk trengs. Lesingene går parallelt over håndtaket.
+SPEAKER_STATE_TTL = 2.0  # sekunder en lest tilstand regnes som fersk
+_speaker_io_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="speaker-io")
+
+def _read_speaker_state(ip):
+    reads = {}
+    live = live_state(ip)
+    if not live:
+        reads["transport"] = _speaker_io_pool.submit(
+            speaker_soap, ip, "avTransport", "GetTransportInfo", [("InstanceID", 0)])
+        reads["media"] = _speaker_io_pool.submit(
+            speaker_soap, ip, "avTransport", "GetMediaInfo", [("InstanceID", 0)])
+    reads.update({
+        "queue": _speaker_io_pool.submit(
+            speaker_soap, ip, "contentDirectory", "Browse", [
+                ("ObjectID", "Q:0"),
+                ("BrowseFlag", "BrowseDirectChildren"),
+                ("Filter", ""),
+                ("StartingIndex", 0),
+                ("RequestedCount", 1),
+                ("SortCriteria", ""),
+            ]),
+    })
+    results = {k: f.result() for k, f in reads.items()}
+    if live:
+        # Transport og kilde-URI kommer fra events; bare køen må leses
+        results["transport"] = {"CurrentTransportState": live["transport"]}
+        results["media"] = {"CurrentURI": live["av_uri"]}
+    first_uri = ""
+    didl = results["queue"].get("Result")
+    if didl:
+        res = ET.fromstring(didl).find(".//{urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/}res")
+        if res is not None:
+            first_uri = (res.text or "").strip()
+    return {
+        "transport": results["transport"].get("CurrentTransportState"),
+        "uri": results["media"].get("CurrentURI") or "",
+        "queue_size": int(results["queue"].get("TotalMatches") or 0),
+        "first_uri": first_uri,
+    }
+
+def speaker_state(ip, max_age=SPEAKER_STATE_TTL):
+    """Cachet tilstand {transport, uri, queue_size, first_uri}; leses på nytt når den er eldre enn max_age."""
+    handle = _speaker_handle(ip)
+    with _speaker_handles_lock:
+        if handle["state"] is not None and time.monotonic() - handle["state_at"] <= max_age:
+            return dict(handle["state"])
+    state = _read_speaker_state(ip)
+    with _speaker_handles_lock:
+        handle["state"] = state
+        handle["state_at"] = time.monotonic()
+    return dict(state)
+
+def invalidate_speaker_state(ip):
+    """Kalles etter alt vi selv gjør med transport eller kø."""
+    with _speaker_handles_lock:
+        handle = _speaker_handles.get(ip)
+        if handle:
+            handle["state"] = None
+
+def speaker_handle_stats():
+    with _speaker_handles_lock:
+        return {
+            ip: {
+                "uid": h["uid"],
+                "calls": h["calls"],
+                "errors": h["errors"],
+                "age_s": int(time.time() - h["created"]),
+            }
+            for ip, h in _speaker_handles.items()
+        }
+
 # =====================================================
 # SERVICE-LAG (ingen Flask request/response eller auth)
 # Enhetlige returverdier: (body:dict, status_code:int)
@@ -108,14 +740,276 @@ def _require_speaker_ip(device_id: str):
         return None, ({"error": "Ingen høyttaler valgt for denne device_id"}, 400)
     return ip, None
 
-def _prepare_sonos(ip: str):
-    sonos = SoCo(ip)
-    sonos.stop()
+ENQUEUE_BATCH_SIZE = 16  # maks antall URI-er per AddMultipleURIsToQueue
+_batch_enqueue_unsupported = set()  # IP-er som har avvist en batch
+
+def _add_uri_to_queue(sonos, uri, metadata):
+    sonos.avTransport.AddURIToQueue([
+        ("InstanceID", 0),
+        ("EnqueuedURI", uri),
+        ("EnqueuedURIMetaData", metadata),
+        ("DesiredFirstTrackNumberEnqueued", 0),
+        ("EnqueueAsNext", 0),
+    ])
+
+def _enqueue_items(sonos, items, progress=None, should_stop=None, write_lock=None):
+    """
+    Legg (uri, didl)-par i køen med AddMultipleURIsToQueue i biter på
+    ENQUEUE_BATCH_SIZE. items kan være en generator; biter hentes etter
+    hvert som de trengs. Avviser høyttaleren en batch, legges biten inn
+    enkeltvis og høyttaleren huskes som uten batch-støtte.
+
+    should_stop sjekkes mellom hvert element og på nytt under write_lock
+    rett før kallet mot høyttaleren, så en avbrutt påfylling aldri skriver.
+    """
+    job_stage("enqueue")
+    t0 = time.monotonic()
+    items = iter(items)
+    enqueued = batches = single_adds = 0
+    stopped = should_stop or (lambda: False)
+    while not stopped():
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= ENQUEUE_BATCH_SIZE or stopped():
+                break
+        if not chunk:
+            break
+        with write_lock or contextlib.nullcontext():
+            if stopped():
+                break
+            batched = _write_chunk(sonos, chunk)
+        if batched:
+            batches += 1
+        else:
+            single_adds += len(chunk)
+        enqueued += len(chunk)
+        if progress:
+            progress(enqueued)
+    return {
+        "enqueued": enqueued,
+        "batches": batches,
+        "single_adds": single_adds,
+        "enqueue_ms": int((time.monotonic() - t0) * 1000),
+    }
+
+def _write_chunk(sonos, chunk):
+    """Legg én bit i køen; True hvis den gikk som én batch."""
+    batched = False
+    # URI-listen er mellomromsseparert, så URI-er med mellomrom må legges inn enkeltvis
+    if (len(chunk) > 1 and sonos.ip_address not in _batch_enqueue_unsupported
+            and not any(" " in uri for uri, _ in chunk)):
+        try:
+            sonos.avTransport.AddMultipleURIsToQueue([
+                ("InstanceID", 0),
+                ("UpdateID", 0),
+                ("NumberOfURIs", len(chunk)),
+                ("EnqueuedURIs", " ".join(uri for uri, _ in chunk)),
+                ("EnqueuedURIsMetaData", " ".join(metadata for _, metadata in chunk)),
+                ("ContainerURI", ""),
+                ("ContainerMetaData", ""),
+                ("DesiredFirstTrackNumberEnqueued", 0),
+                ("EnqueueAsNext", 0),
+            ])
+            batched = True
+        except SoCoUPnPException as e:
+            # Bare et UPnP-svar betyr at høyttaleren avviser kallet; nettverksfeil
+            # sendes videre, siden batchen da kan ha blitt lagt inn likevel.
+            print(f"AddMultipleURIsToQueue avvist av {sonos.ip_address}, legger inn enkeltvis:", e)
+            _batch_enqueue_unsupported.add(sonos.ip_address)
+    if not batched:
+        for uri, metadata in chunk:
+            _add_uri_to_queue(sonos, uri, metadata)
+    return batched
+
+# Hurtigstart: første element legges i kø og spilles straks, resten fylles på
+# av en bakgrunnstråd per høyttaler. Ny avspilling på samme høyttaler avbryter
+# påfyllet før køen tømmes. Fremdrift: GET /queue/fill?device_id=...
+FAST_START = os.environ.get("SOCORFID_FAST_START", "1") != "0"
+_queue_fills = {}  # ip -> påfyll-dict
+_queue_write_locks = {}  # ip -> lås rundt hver kø-skriving fra påfyllet
+_queue_fills_lock = threading.Lock()
+
+# Lat kø (glidende vindu): bare LAZY_WINDOW kommende elementer ligger på
+# høyttaleren. Påfyllstråden følger spor-nummeret (fra events, ellers polling)
+# og legger til flere når det er færre enn LAZY_LOW_WATER igjen, så køen holdes
+# liten uansett seriens lengde. Mens høyttaleren ikke spiller, spørres det sjeldnere.
+LAZY_QUEUE = os.environ.get("SOCORFID_LAZY_QUEUE", "0") == "1"
+LAZY_WINDOW = int(os.environ.get("SOCORFID_LAZY_WINDOW", "5"))
+LAZY_LOW_WATER = max(1, LAZY_WINDOW // 2)
+LAZY_POLL_INTERVAL = 10.0
+LAZY_PAUSED_POLL_MAX = 120.0  # pollingen dobles opp til dette mens høyttaleren ikke spiller
+LAZY_IDLE_TIMEOUT = 6 * 3600  # slipp økten hvis sporet ikke har flyttet seg på så lenge
+
+def _use_fast_start(fast_start):
+    return FAST_START if fast_start is None else bool(fast_start)
+
+def _use_lazy(lazy):
+    return LAZY_QUEUE if lazy is None else bool(lazy)
+
+def _queue_fill_public(fill):
+    return {k: v for k, v in fill.items() if k not in ("cancel", "thread", "uris", "write_lock")}
+
+def _queue_write_lock(ip):
+    with _queue_fills_lock:
+        return _queue_write_locks.setdefault(ip, threading.Lock())
+
+def _fill_all(sonos, fill, items):
+    already = fill["enqueued"]
+
+    def progress(n):
+        fill["enqueued"] = already + n
+
+    _enqueue_items(sonos, items, progress=progress, should_stop=fill["cancel"].is_set,
+                   write_lock=fill["write_lock"])
+    return "cancelled" if fill["cancel"].is_set() else "done"
+
+def _lazy_position(sonos):
+    """
+    (transport, spornummer, spor-URI). Fra AVTransport-events når vi abonnerer,
+    ellers fra høyttaleren; posisjonen leses da bare mens den spiller.
+    """
+    live = live_state(sonos.ip_address)
+    if live and live["track_nr"] is not None:
+        return live["transport"], live["track_nr"], (live["track"] or {}).get("uri")
+    transport = sonos.avTransport.GetTransportInfo([("InstanceID", 0)]).get("CurrentTransportState")
+    if transport != "PLAYING":
+        return transport, None, None
+    info = sonos.avTransport.GetPositionInfo([("InstanceID", 0), ("Channel", "Master")])
+    return transport, int(info.get("Track") or 0), info.get("TrackURI")
+
+def _fill_window(sonos, fill, items):
+    cancel = fill["cancel"]
+    last_move = time.monotonic()
+    interval = LAZY_POLL_INTERVAL
+    while True:
+        remaining = fill["enqueued"] - fill["position"]
+        if remaining < LAZY_LOW_WATER:
+            need = LAZY_WINDOW - remaining
+            batch = list(itertools.islice(items, need))
+            if cancel.is_set():
+                return "cancelled"
+            if batch:
+                _enqueue_items(sonos, batch, should_stop=cancel.is_set, write_lock=fill["write_lock"])
+                fill["uris"].update(uri for uri, _ in batch)
+                fill["enqueued"] += len(batch)
+            if len(batch) < need:
+                return "done"  # kilden er tom; resten spilles fra køen
+        if cancel.wait(interval):
+            return "cancelled"
+        transport, track, track_uri = _lazy_position(sonos)
+        if transport != "PLAYING":
+            # Pause/stopp: sporet flytter seg ikke, så spør sjeldnere til den spiller igjen
+            interval = min(interval * 2, LAZY_PAUSED_POLL_MAX)
+            if time.monotonic() - last_move > LAZY_IDLE_TIMEOUT:
+                return "expired"
+            continue
+        interval = LAZY_POLL_INTERVAL
+        if not track or track_uri not in fill["uris"]:
+            return "stopped"  # køen er byttet ut av noen andre
+        if track != fill["position"]:
+            fill["position"] = track
+            last_move = time.monotonic()
+        elif time.monotonic() - last_move > LAZY_IDLE_TIMEOUT:
+            return "expired"
+
+def _start_queue_fill(sonos, items, already=0, lazy=False, uris=()):
+    ip = sonos.ip_address
+    fill = {
+        "mode": "lazy" if lazy else "full",
+        "state": "running",
+        "enqueued": already,
+        "position": 1,
+        "started_at": time.time(),
+        "finished_at": None,
+        "error": None,
+        "cancel": threading.Event(),
+        "write_lock": _queue_write_lock(ip),
+        "thread": None,
+        "uris": set(uris),
+    }
+    if lazy:
+        fill["window"] = LAZY_WINDOW
+
+    def run():
+        try:
+            fill["state"] = (_fill_window if lazy else _fill_all)(sonos, fill, iter(items))
+        except Exception as e:
+            fill["state"] = "error"
+            fill["error"] = str(e)
+            print(f"Påfylling av kø på {ip} feilet:", e)
+        fill["finished_at"] = time.time()
+
+    fill["thread"] = threading.Thread(target=run, name=f"queue-fill-{ip}", daemon=True)
+    with _queue_fills_lock:
+        _queue_fills[ip] = fill
+    fill["thread"].start()
+    return fill
+
+def _cancel_queue_fill(ip):
+    """
+    Avbryt påfyllet uten å vente på tråden. Avbruddet settes under
+    skrivelåsen: et kall som er i gang får fullføre, og alle senere
+    kø-skrivinger fra tråden ser flagget og dropper seg selv.
+    """
+    with _queue_fills_lock:
+        fill = _queue_fills.get(ip)
+    if fill and fill["state"] == "running":
+        with fill["write_lock"]:
+            fill["cancel"].set()
+
+def queue_fill_status(ip):
+    with _queue_fills_lock:
+        fill = _queue_fills.get(ip)
+    return _queue_fill_public(fill) if fill else None
+
+def _play_first_then_fill(sonos, first, rest, lazy=False):
+    """Spill første (uri, didl) nå og fyll resten av køen (eller et vindu av den) i bakgrunnen."""
+    job_stage("play")
+    _add_uri_to_queue(sonos, *first)
+    sonos.play_from_queue(0, start=True)
+    return _queue_fill_public(_start_queue_fill(sonos, rest, already=1, lazy=lazy, uris=[first[0]]))
+
+def _end_direct_control(ip):
     try:
-        sonos.avTransport.EndDirectControlSession([("InstanceID", 0)])
+        speaker_soap(ip, "avTransport", "EndDirectControlSession", [("InstanceID", 0)])
     except Exception:
         pass
-    sonos.clear_queue()
+
+def _prepare_sonos(ip: str):
+    """
+    Gjør høyttaleren klar for en ny kø: stoppet, ingen direktekontroll-økt
+    (Spotify Connect o.l.) og tom kø. Kun kallene som trengs sendes.
+    """
+    job_stage("prepare")
+    _cancel_queue_fill(ip)  # et påfyll fra forrige avspilling skal ikke havne i den nye køen
+    forget_loaded_card(ip)
+    sonos = get_sonos(ip)
+    try:
+        state = speaker_state(ip)
+    except Exception as e:
+        print("Kunne ikke lese tilstand, forbereder fullt:", e)
+        state = {"transport": "PLAYING", "uri": "x-sonos-vli:", "queue_size": 1}
+    uri = state["uri"]
+    direct = uri.startswith("x-sonos-vli:")
+    clear = state["queue_size"] > 0
+    # Å tømme køen stopper avspilling fra køen; Stop trengs ellers bare når noe spiller
+    stop = state["transport"] not in ("STOPPED", "NO_MEDIA_PRESENT") and not (
+        clear and uri.startswith("x-rincon-queue:"))
+    try:
+        # Stop og avslutning av direktekontroll er uavhengige og sendes samtidig
+        pending = []
+        if stop:
+            pending.append(_speaker_io_pool.submit(
+                speaker_soap, ip, "avTransport", "Stop", [("InstanceID", 0), ("Speed", 1)]))
+        if direct:
+            pending.append(_speaker_io_pool.submit(_end_direct_control, ip))
+        for fut in pending:
+            fut.result()
+        if clear:
+            speaker_soap(ip, "avTransport", "RemoveAllTracksFromQueue", [("InstanceID", 0)])
+    finally:
+        invalidate_speaker_state(ip)
     return sonos
 
 # ---------- PlayLink ----------
@@ -155,20 +1049,107 @@ def generate_sonos_uri(nrk_url, program_id=None):
     sonos_uri = f"x-sonos-http:series%3a{urllib.parse.quote(series_name)}%3a1%3a{program_id}.unknown?sid=277&flags=0&sn=14"
     return sonos_uri
 
-def fetch_nrk_metadata(program_id):
+# NRK-metadata caches i state-lageret med ETag/Last-Modified. Innenfor TTL
+# brukes cachen direkte; etter TTL serveres den gamle kopien umiddelbart
+# mens en bakgrunnstråd revaliderer betinget (stale-while-revalidate).
+NRK_METADATA_TTL = int(os.environ.get("SOCORFID_NRK_TTL", str(6 * 3600)))
+_nrk_stats = {"hits": 0, "misses": 0, "stale": 0, "revalidated": 0, "refreshed": 0, "errors": 0}
+_nrk_stats_lock = threading.Lock()
+_nrk_revalidating = set()
+_nrk_revalidate_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="nrk-revalidate")
+
+def _nrk_count(key):
+    with _nrk_stats_lock:
+        _nrk_stats[key] += 1
+
+def nrk_metadata_stats():
+    with _nrk_stats_lock:
+        stats = dict(_nrk_stats)
+    stats["ttl_s"] = NRK_METADATA_TTL
+    return stats
+
+def _nrk_cache_get(program_id):
+    return _db().execute(
+        "SELECT body, etag, last_modified, fetched_at FROM nrk_metadata_cache WHERE program_id = ?",
+        (program_id,),
+    ).fetchone()
+
+def _nrk_cache_put(program_id, body, etag, last_modified):
+    with _db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO nrk_metadata_cache (program_id, body, etag, last_modified, fetched_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (program_id, body, etag, last_modified, time.time()),
+        )
+
+def _nrk_cache_touch(program_id):
+    with _db() as conn:
+        conn.execute("UPDATE nrk_metadata_cache SET fetched_at = ? WHERE program_id = ?",
+                     (time.time(), program_id))
+
+def _fetch_nrk_metadata_remote(program_id, cached=None):
+    """GET mot psapi, betinget hvis vi har en cachet kopi. Returnerer dict."""
     api_url = f"https://psapi.nrk.no/playback/metadata/program/{program_id}"
-    response = requests.get(api_url)
+    headers = {}
+    if cached is not None:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+    response = http_get(api_url, headers=headers)
+    if response.status_code == 304 and cached is not None:
+        _nrk_cache_touch(program_id)
+        _nrk_count("revalidated")
+        return json.loads(cached["body"])
     if response.status_code != 200:
         raise ValueError(f"Kunne ikke hente NRK metadata for {program_id}: HTTP {response.status_code}")
-    return response.json()
+    data = response.json()
+    _nrk_cache_put(program_id, response.text, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    if cached is not None:
+        _nrk_count("refreshed")
+    return data
+
+def _revalidate_nrk_metadata(program_id):
+    try:
+        _fetch_nrk_metadata_remote(program_id, _nrk_cache_get(program_id))
+    except Exception as e:
+        _nrk_count("errors")
+        print(f"Revalidering av NRK metadata for {program_id} feilet:", e)
+    finally:
+        with _nrk_stats_lock:
+            _nrk_revalidating.discard(program_id)
 
-def build_didl_metadata(sonos_uri, metadata_api):
+def fetch_nrk_metadata(program_id):
+    cached = _nrk_cache_get(program_id)
+    if cached is None:
+        _nrk_count("misses")
+        return _fetch_nrk_metadata_remote(program_id)
+    if time.time() - cached["fetched_at"] < NRK_METADATA_TTL:
+        _nrk_count("hits")
+        return json.loads(cached["body"])
+    # Utløpt: server gammel kopi nå, revalider i bakgrunnen (én gang per program_id)
+    _nrk_count("stale")
+    with _nrk_stats_lock:
+        start = program_id not in _nrk_revalidating
+        _nrk_revalidating.add(program_id)
+    if start:
+        _nrk_revalidate_pool.submit(_revalidate_nrk_metadata, program_id)
+    return json.loads(cached["body"])
+
+def _nrk_episode_fields(metadata_api):
+    """(title, duration, album_art) fra psapi-metadata."""
     title = metadata_api.get("preplay", {}).get("titles", {}).get("subtitle", "Ukjent tittel")
     iso_duration = metadata_api.get("duration", "PT0S")
     duration = iso_duration_to_hms(iso_duration)
     poster_images = metadata_api.get("preplay", {}).get("poster", {}).get("images", [])
     album_art = poster_images[-1]["url"] if poster_images else ""
-    
+    return title, duration, album_art
+
+def _nrk_next_program_id(metadata_api):
+    next_href = ((metadata_api.get("_links") or {}).get("next") or {}).get("href")
+    return next_href.split("/")[-1] if next_href else None
+
+def _didl_for_nrk_episode(sonos_uri, title, duration, album_art):
     didl_metadata = (
         '<DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/" '
         'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" '
@@ -184,54 +1165,149 @@ def build_didl_metadata(sonos_uri, metadata_api):
     )
     return didl_metadata
 
-def _build_nrk_series_queue(nrk_url):
-    episodes = []
-    series_name = nrk_url.rstrip('/').split('/')[-2]
-    current_url = nrk_url
-
-    while True:
-        current_program_id = get_program_id(current_url)
-        sonos_uri = generate_sonos_uri(current_url, current_program_id)
-        metadata_api = fetch_nrk_metadata(current_program_id)
-        didl_metadata = build_didl_metadata(sonos_uri, metadata_api)
-        episodes.append((sonos_uri, didl_metadata))
-        
-        links = metadata_api.get("_links")
-        next_href = None
-        if links:
-            next_dict = links.get("next")
-            if next_dict:
-                next_href = next_dict.get("href")
-        
-        if not next_href:
+# Episodekjeden (program_id -> neste program_id + tittel/varighet/bilde)
+# lagres i state-lageret. Gjentatte avspillinger leser hele kjeden med én
+# spørring og henter bare halen etter siste kjente episode fra NRK.
+NRK_CHAIN_MAX = 1000       # vern mot sykler/uendelige kjeder
+NRK_CHAIN_WORKERS = 6      # parallell oppfrisking av utdatert metadata
+_nrk_chain_pool = ThreadPoolExecutor(max_workers=NRK_CHAIN_WORKERS, thread_name_prefix="nrk-chain")
+
+def _load_episode_chain(start_id):
+    """Følg next-pekerne fra start_id i lageret. Siste element kan være ukjent (known=0)."""
+    rows = _db().execute(
+        """
+        WITH RECURSIVE chain(program_id, depth) AS (
+            SELECT ?, 0
+            UNION ALL
+            SELECT e.next_program_id, chain.depth + 1
+            FROM nrk_episode_chain e JOIN chain ON e.program_id = chain.program_id
+            WHERE e.next_program_id IS NOT NULL AND chain.depth < ?
+        )
+        SELECT chain.program_id, e.next_program_id, e.title, e.duration, e.album_art, e.updated_at,
+               e.program_id IS NOT NULL AS known
+        FROM chain LEFT JOIN nrk_episode_chain e ON e.program_id = chain.program_id
+        ORDER BY chain.depth
+        """,
+        (start_id, NRK_CHAIN_MAX),
+    ).fetchall()
+    chain, seen = [], set()
+    for r in rows:
+        if r["program_id"] in seen:
             break
-        
-        next_program_id = next_href.split("/")[-1]
-        current_url = f"https://radio.nrk.no/serie/{series_name}/{next_program_id}"
+        seen.add(r["program_id"])
+        chain.append(dict(r))
+    return chain
+
+def _store_episode_rows(rows):
+    now = time.time()
+    with _db() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO nrk_episode_chain "
+            "(program_id, next_program_id, title, duration, album_art, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            [(r["program_id"], r["next_program_id"], r["title"], r["duration"], r["album_art"], now) for r in rows],
+        )
+
+def _resolve_nrk_episode(program_id, revalidate=False):
+    if revalidate:
+        # Betinget GET forbi TTL/stale-logikken (304 koster nesten ingenting)
+        metadata_api = _fetch_nrk_metadata_remote(program_id, _nrk_cache_get(program_id))
+    else:
+        metadata_api = fetch_nrk_metadata(program_id)
+    title, duration, album_art = _nrk_episode_fields(metadata_api)
+    return {
+        "program_id": program_id,
+        "next_program_id": _nrk_next_program_id(metadata_api),
+        "title": title,
+        "duration": duration,
+        "album_art": album_art,
+        "known": 1,
+    }
+
+def _refresh_episode_rows(program_ids):
+    futures = [_nrk_chain_pool.submit(_resolve_nrk_episode, pid, True) for pid in program_ids]
+    rows = []
+    for fut in futures:
+        try:
+            rows.append(fut.result())
+        except Exception as e:
+            print("Oppfrisking av NRK-episode feilet:", e)
+    if rows:
+        _store_episode_rows(rows)
+
+def _iter_nrk_chain(start_id):
+    """Gi episodene i rekkefølge etter hvert som de blir kjent (lagrede først, så halen)."""
+    chain = _load_episode_chain(start_id)
+    known = [r for r in chain if r["known"]]
+    yield from known
+
+    # Halen: siste kjente episode kan ha fått en ny "next" siden sist
+    # (fetch_nrk_metadata er cachet, så dette koster normalt ingen HTTP).
+    if known and not known[-1]["next_program_id"]:
+        latest = _resolve_nrk_episode(known[-1]["program_id"])
+        if latest["next_program_id"]:
+            known[-1]["next_program_id"] = latest["next_program_id"]
+            _store_episode_rows([latest])
+
+    # Følg kjeden videre fra første ukjente id; next-lenker må nødvendigvis hentes serielt
+    seen = {r["program_id"] for r in known}
+    cursor = known[-1]["next_program_id"] if known else start_id
+    while cursor and cursor not in seen and len(known) < NRK_CHAIN_MAX:
+        try:
+            row = _resolve_nrk_episode(cursor)
+        except Exception:
+            if not known:
+                raise
+            print(f"Stopper NRK-kjeden ved {cursor}; spiller de {len(known)} kjente episodene")
+            break
+        _store_episode_rows([row])
+        known.append(row)
+        seen.add(cursor)
+        yield row
+        cursor = row["next_program_id"]
+
+    # Utdaterte rader friskes opp parallelt i bakgrunnen til neste avspilling
+    cutoff = time.time() - NRK_METADATA_TTL
+    outdated = [r["program_id"] for r in known if r.get("updated_at") and r["updated_at"] < cutoff]
+    if outdated:
+        threading.Thread(target=_refresh_episode_rows, args=(outdated,), daemon=True).start()
+
+def _iter_nrk_series_queue(nrk_url):
+    job_stage("resolve")
+    for row in _iter_nrk_chain(get_program_id(nrk_url)):
+        sonos_uri = generate_sonos_uri(nrk_url, row["program_id"])
+        didl_metadata = _didl_for_nrk_episode(sonos_uri, row["title"], row["duration"], row["album_art"])
+        yield sonos_uri, didl_metadata
 
-    return episodes
+def _build_nrk_series_queue(nrk_url):
+    return list(_iter_nrk_series_queue(nrk_url))
 
-def svc_play_nrk_program(device_id: str, nrk_url: str):
+def svc_play_nrk_program(device_id: str, nrk_url: str, fast_start=None, lazy=None):
     ip, err = _require_speaker_ip(device_id)
     if err: return err
     try:
+        lazy = _use_lazy(lazy)
+        if lazy or _use_fast_start(fast_start):
+            episodes = _iter_nrk_series_queue(nrk_url)
+            first = next(episodes, None)
+            if first is None:
+                return ({"error": "Fant ingen episoder"}, 500)
+            sonos = _prepare_sonos(ip)
+            fill = _play_first_then_fill(sonos, first, episodes, lazy=lazy)
+            return ({"status": "Avspilling startet fra NRK program (hurtigstart)",
+                     "antall_episoder": fill["enqueued"], "fast_start": True, "fill": fill}, 200)
+
         episodes = _build_nrk_series_queue(nrk_url)
         sonos = _prepare_sonos(ip)
-        for (uri, metadata) in episodes:
-            sonos.avTransport.AddURIToQueue([
-                ("InstanceID", 0),
-                ("EnqueuedURI", uri),
-                ("EnqueuedURIMetaData", metadata),
-                ("DesiredFirstTrackNumberEnqueued", 0),
-                ("EnqueueAsNext", 0),
-            ])
+        enqueue = _enqueue_items(sonos, episodes)
         sonos.play_from_queue(0, start=True)
-        return ({"status": "Avspilling startet fra NRK program", "antall_episoder": len(episodes)}, 200)
+        return ({"status": "Avspilling startet fra NRK program", "antall_episoder": len(episodes),
+                 "enqueue": enqueue}, 200)
     except Exception as e:
         return ({"error": str(e)}, 500)
 
 # ---------- NRK Podcast ----------
 import html
+import codecs
 import unicodedata
 
 def _norm(s):
@@ -241,22 +1317,38 @@ def _norm(s):
     s = re.sub(r"\s+", " ", s).strip()
     return s
 
-def extract_episode_title(episode_page_url, episode_id=None):
-    """Hent episodetittel fra NRK-episode-siden."""
-    resp = requests.get(episode_page_url, timeout=10)
-    resp.raise_for_status()
-    html_text = resp.text
+EPISODE_PAGE_CHUNK = 16384
+_EPISODE_TITLE_AFTER_ANCHOR = re.compile(r'"titles"\s*:\s*\{\s*"title"\s*:\s*"([^"]+)"')
 
+def extract_episode_title(episode_page_url, episode_id=None):
+    """
+    Hent episodetittel fra NRK-episode-siden. Siden leses som strøm og
+    nedlastingen stoppes så snart JSON-tittelen for episoden er funnet.
+    """
     if not episode_id:
         episode_id = episode_page_url.rstrip("/").split("/")[-1]
-
-    m = re.search(
-        r'"episodeId"\s*:\s*"' + re.escape(episode_id) + r'".*?"titles"\s*:\s*\{\s*"title"\s*:\s*"([^"]+)"',
-        html_text,
-        re.DOTALL,
-    )
-    if m:
-        return _norm(html.unescape(m.group(1)))
+    anchor_re = re.compile(r'"episodeId"\s*:\s*"' + re.escape(episode_id) + r'"')
+
+    html_text = ""
+    anchor = None
+    scanned = 0
+    with http_get(episode_page_url, stream=True) as resp:
+        resp.raise_for_status()
+        decoder = codecs.getincrementaldecoder(resp.encoding or "utf-8")(errors="replace")
+        for chunk in resp.iter_content(chunk_size=EPISODE_PAGE_CHUNK):
+            html_text += decoder.decode(chunk)
+            # Søk bare i det nye (med litt overlapp), ikke hele bufferen hver gang
+            start = max(scanned - 1024, anchor or 0)
+            scanned = len(html_text)
+            if anchor is None:
+                m = anchor_re.search(html_text, start)
+                if not m:
+                    continue
+                anchor = start = m.end()
+            m = _EPISODE_TITLE_AFTER_ANCHOR.search(html_text, start)
+            if m:
+                return _norm(html.unescape(m.group(1)))
+        html_text += decoder.decode(b"", final=True)
 
     m2 = re.search(r'<meta property="og:title" content="([^"]+)"', html_text)
     if m2:
@@ -266,40 +1358,174 @@ def extract_episode_title(episode_page_url, episode_id=None):
         return _norm(html.unescape(m3.group(1)))
     raise ValueError("Kunne ikke finne episodetittel i NRK-siden.")
 
-def find_enclosure_by_title(xml_path, wanted_title):
-    """Returner (mp3_url, meta) for item der <title> matcher wanted_title."""
-    with open(xml_path, "rb") as f:
-        xml_content = f.read()
-    root = ET.fromstring(xml_content)
-    items = root.findall("./channel/item")
-
-    wt = _norm(wanted_title)
+def _episode_cache_get(episode_id):
+    return _db().execute(
+        "SELECT slug, title, enclosure_url, duration, album_art FROM nrk_episode_titles WHERE episode_id = ?",
+        (episode_id,),
+    ).fetchone()
+
+def _episode_cache_put(episode_id, slug, title, enclosure_url, meta):
+    with _db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO nrk_episode_titles "
+            "(episode_id, slug, title, enclosure_url, duration, album_art, resolved_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (episode_id, slug, title, enclosure_url, meta["duration"], meta["album_art"], time.time()),
+        )
+
+def resolve_podcast_episode(slug, episode_id, episode_page_url):
+    """
+    (mp3_url, meta) for en NRK-podkastepisode. Kjente episoder slås opp i
+    cachen og feed-indeksen uten nettverk; ellers hentes tittelen fra NRK.
+    """
+    job_stage("resolve")
+    xml_file = os.path.join(PODCAST_FEED_DIR, f"{slug}.xml")
+    cached = _episode_cache_get(episode_id)
+    if cached:
+        try:
+            # Feed-indeksen gir fersk enclosure hvis feeden er oppdatert
+            return find_enclosure_by_title(xml_file, cached["title"])
+        except (OSError, ValueError):
+            meta = {"title": cached["title"], "duration": cached["duration"], "album_art": cached["album_art"]}
+            return cached["enclosure_url"], meta
+
+    # 1) Finn tittel fra NRK-episode-siden
+    title = extract_episode_title(episode_page_url, episode_id=episode_id)
+    # 2) Slå opp mp3 i lokal XML
+    mp3_url, meta = find_enclosure_by_title(xml_file, title)
+    _episode_cache_put(episode_id, slug, meta["title"], mp3_url, meta)
+    return mp3_url, meta
+
+# Tittelindeks per feed: normalisert tittel -> enclosure/varighet/bilde.
+# Lagres som JSON ved siden av PODCAST_FEED_DIR og bygges på nytt bare når
+# XML-filens mtime/størrelse endres.
+PODCAST_INDEX_DIR = os.environ.get("SOCORFID_PODCAST_INDEX_DIR", PODCAST_FEED_DIR.rstrip("/") + ".index")
+_feed_indexes = {}  # xml_path -> index-dict
+_feed_index_lock = threading.Lock()
+
+def _build_feed_index(xml_path):
+    root = ET.parse(xml_path).getroot()
     ns = {"itunes": "http://www.itunes.com/dtds/podcast-1.0.dtd"}
-
-    for item in items:
+    items = {}
+    for item in root.findall("./channel/item"):
         title_el = item.find("title")
         title = _norm(title_el.text if title_el is not None else "")
-        if title != wt:
-            continue
         enclosure = item.find("enclosure")
-        if enclosure is None or "url" not in enclosure.attrib:
-            continue
-        mp3 = enclosure.attrib["url"]
+        if title in items or enclosure is None or "url" not in enclosure.attrib:
+            continue  # første treff vinner, som før
         duration_el = item.find("itunes:duration", ns)
-        duration = duration_el.text if duration_el is not None else "0:00:00"
         image_el = item.find("itunes:image", ns)
-        album_art = image_el.attrib.get("href") if image_el is not None else ""
-        meta = {"title": title, "duration": duration, "album_art": album_art}
-        return mp3, meta
+        items[title] = {
+            "url": enclosure.attrib["url"],
+            "duration": duration_el.text if duration_el is not None else "0:00:00",
+            "album_art": image_el.attrib.get("href") if image_el is not None else "",
+        }
+    return items
+
+def _feed_index(xml_path):
+    st = os.stat(xml_path)
+    signature = [st.st_mtime_ns, st.st_size]
+    idx = _feed_indexes.get(xml_path)
+    if idx is not None and idx["signature"] == signature:
+        return idx["items"]
+    with _feed_index_lock:
+        idx = _feed_indexes.get(xml_path)
+        if idx is not None and idx["signature"] == signature:
+            return idx["items"]
+        index_path = os.path.join(PODCAST_INDEX_DIR, os.path.basename(xml_path) + ".json")
+        try:
+            idx = _read_json_file(index_path)
+        except ValueError:
+            idx = {}  # ødelagt indeksfil bygges på nytt
+        if idx.get("signature") != signature:
+            idx = {"signature": signature, "items": _build_feed_index(xml_path)}
+            try:
+                os.makedirs(PODCAST_INDEX_DIR, exist_ok=True)
+                _atomic_write_json(index_path, idx)
+            except OSError as e:
+                print("Kunne ikke lagre feed-indeks:", e)
+        _feed_indexes[xml_path] = idx
+        return idx["items"]
 
-    raise ValueError("Episoden ble ikke funnet i XML.")
+def find_enclosure_by_title(xml_path, wanted_title):
+    """Returner (mp3_url, meta) for item der <title> matcher wanted_title."""
+    wt = _norm(wanted_title)
+    entry = _feed_index(xml_path).get(wt)
+    if entry is None:
+        raise ValueError("Episoden ble ikke funnet i XML.")
+    meta = {"title": wt, "duration": entry["duration"], "album_art": entry["album_art"]}
+    return entry["url"], meta
+
+def _didl_for_podcast_item(url, title, duration, album_art):
+    return (
+        '<DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/" '
+        'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" '
+        'xmlns:r="urn:schemas-rinconnetworks-com:metadata-1-0/" '
+        'xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">'
+        '<item id="-1" parentID="-1" restricted="true">'
+        f'<res protocolInfo="sonos.com-http:*:audio/mpeg:*" duration="{saxutils.escape(duration)}">{saxutils.escape(url)}</res>'
+        f'<dc:title>{saxutils.escape(title)}</dc:title>'
+        f'<upnp:albumArtURI>{saxutils.escape(album_art)}</upnp:albumArtURI>'
+        '<upnp:class>object.item.audioItem.show</upnp:class>'
+        '</item>'
+        '</DIDL-Lite>'
+    )
 
-def svc_play_nrk_podcast(device_id: str, media: str):
+def _iter_feed_episodes(xml_path):
+    """
+    Strøm (url, didl) for hver <item> i feeden med iterparse. Hvert ferdig
+    element tømmes og fjernes fra <channel>, så minnebruken holder seg flat
+    uansett hvor mange episoder feeden har.
+    """
+    ns = {"itunes": "http://www.itunes.com/dtds/podcast-1.0.dtd"}
+    channel = None
+    for event, elem in ET.iterparse(xml_path, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "channel" and channel is None:
+                channel = elem
+            continue
+        if elem.tag != "item":
+            continue
+        title_el = elem.find("title")
+        title = title_el.text if title_el is not None else "Ukjent tittel"
+        enclosure = elem.find("enclosure")
+        if enclosure is not None and "url" in enclosure.attrib:
+            duration_el = elem.find("itunes:duration", ns)
+            duration = duration_el.text if duration_el is not None else "0:00:00"
+            image_el = elem.find("itunes:image", ns)
+            album_art = image_el.attrib.get("href") if image_el is not None else ""
+            url = enclosure.attrib["url"]
+            yield url, _didl_for_podcast_item(url, title, duration, album_art)
+        elem.clear()
+        if channel is not None:
+            try:
+                channel.remove(elem)
+            except ValueError:
+                pass
+
+def _didl_for_podcast_episode(mp3_url, meta):
+    return (
+        '<DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/" '
+        'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" '
+        'xmlns:r="urn:schemas-rinconnetworks-com:metadata-1-0/" '
+        'xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">'
+        '<item id="-1" parentID="-1" restricted="true">'
+        f'<dc:title>{saxutils.escape(meta["title"])}</dc:title>'
+        '<upnp:class>object.item.audioItem</upnp:class>'
+        f'<upnp:albumArtURI>{saxutils.escape(meta["album_art"])}</upnp:albumArtURI>'
+        f'<res protocolInfo="sonos.com-http:*:audio/mpeg:*" duration="{saxutils.escape(meta["duration"])}">{saxutils.escape(mp3_url)}</res>'
+        '</item>'
+        '</DIDL-Lite>'
+    )
+
+_PODCAST_EPISODE_URL = re.compile(r'^https?://radio\.nrk\.no/podkast/([a-z0-9_]+)/([A-Za-z0-9_-]+)$', re.IGNORECASE)
+
+def svc_play_nrk_podcast(device_id: str, media: str, fast_start=None, lazy=None):
     ip, err = _require_speaker_ip(device_id)
     if err: return err
     try:
         # Detekter episode-URL
-        m_ep = re.match(r'^https?://radio\.nrk\.no/podkast/([a-z0-9_]+)/([A-Za-z0-9_-]+)$', media, re.IGNORECASE)
+        m_ep = _PODCAST_EPISODE_URL.match(media)
 
         sonos = _prepare_sonos(ip)
 
@@ -308,112 +1534,170 @@ def svc_play_nrk_podcast(device_id: str, media: str):
             slug = m_ep.group(1)
             episode_id = m_ep.group(2)
 
-            # 1) Finn tittel fra NRK-episode-siden
-            title = extract_episode_title(media, episode_id=episode_id)
-
-            # 2) Slå opp mp3 i lokal XML
-            xml_file = os.path.join(PODCAST_FEED_DIR, f"{slug}.xml")
-            mp3_url, meta = find_enclosure_by_title(xml_file, title)
+            # 1+2) Tittel (cache eller NRK-siden) -> mp3 i lokal XML
+            mp3_url, meta = resolve_podcast_episode(slug, episode_id, media)
 
             # 3) Legg kun denne i kø
-            metadata = (
-                '<DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/" '
-                'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" '
-                'xmlns:r="urn:schemas-rinconnetworks-com:metadata-1-0/" '
-                'xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">'
-                '<item id="-1" parentID="-1" restricted="true">'
-                f'<dc:title>{saxutils.escape(meta["title"])}</dc:title>'
-                '<upnp:class>object.item.audioItem</upnp:class>'
-                f'<upnp:albumArtURI>{saxutils.escape(meta["album_art"])}</upnp:albumArtURI>'
-                f'<res protocolInfo="sonos.com-http:*:audio/mpeg:*" duration="{saxutils.escape(meta["duration"])}">{saxutils.escape(mp3_url)}</res>'
-                '</item>'
-                '</DIDL-Lite>'
-            )
-            sonos.avTransport.AddURIToQueue([
-                ("InstanceID", 0),
-                ("EnqueuedURI", mp3_url),
-                ("EnqueuedURIMetaData", metadata),
-                ("DesiredFirstTrackNumberEnqueued", 0),
-                ("EnqueueAsNext", 0),
-            ])
+            _add_uri_to_queue(sonos, mp3_url, _didl_for_podcast_episode(mp3_url, meta))
             sonos.play_from_queue(0, start=True)
             return ({"status": "NRK episode-avspilling startet", "episode_title": meta["title"], "mp3": mp3_url}, 200)
 
-        # Ellers: hele feeden fra XML-fil (eksisterende oppførsel)
+        # Ellers: hele feeden fra XML-fil (eksisterende oppførsel), strømmet
+        # fra parser rett inn i køen
         full_path = os.path.join(PODCAST_FEED_DIR, media)
-        with open(full_path, "rb") as f:
-            xml_content = f.read()
-        
-        root = ET.fromstring(xml_content)
-        items = root.findall("./channel/item")
-        if not items:
+        lazy = _use_lazy(lazy)
+        if lazy or _use_fast_start(fast_start):
+            episodes = _iter_feed_episodes(full_path)
+            first = next(episodes, None)
+            if first is None:
+                return ({"error": "Ingen episoder funnet i feeden"}, 500)
+            fill = _play_first_then_fill(sonos, first, episodes, lazy=lazy)
+            return ({"status": "NRK podcast-avspilling startet (hurtigstart)",
+                     "antall_episoder": fill["enqueued"], "fast_start": True, "fill": fill}, 200)
+
+        enqueue = _enqueue_items(sonos, _iter_feed_episodes(full_path))
+        if not enqueue["enqueued"]:
             return ({"error": "Ingen episoder funnet i feeden"}, 500)
-
-        ns = {"itunes": "http://www.itunes.com/dtds/podcast-1.0.dtd"}
-        count = 0
-        for item in items:
-            title_el = item.find("title")
-            title = title_el.text if title_el is not None else "Ukjent tittel"
-            enclosure = item.find("enclosure")
-            if enclosure is None or "url" not in enclosure.attrib:
-                continue
-            podcast_episode_url = enclosure.attrib["url"]
-            duration_el = item.find("itunes:duration", ns)
-            duration = duration_el.text if duration_el is not None else "0:00:00"
-            image_el = item.find("itunes:image", ns)
-            album_art = image_el.attrib.get("href") if image_el is not None else ""
-            
-            metadata = (
-                '<DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/" '
-                'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" '
-                'xmlns:r="urn:schemas-rinconnetworks-com:metadata-1-0/" '
-                'xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">'
-                '<item id="-1" parentID="-1" restricted="true">'
-                f'<res protocolInfo="sonos.com-http:*:audio/mpeg:*" duration="{saxutils.escape(duration)}">{saxutils.escape(podcast_episode_url)}</res>'
-                f'<dc:title>{saxutils.escape(title)}</dc:title>'
-                f'<upnp:albumArtURI>{saxutils.escape(album_art)}</upnp:albumArtURI>'
-                '<upnp:class>object.item.audioItem.show</upnp:class>'
-                '</item>'
-                '</DIDL-Lite>'
-            )
-            sonos.avTransport.AddURIToQueue([
-                ("InstanceID", 0),
-                ("EnqueuedURI", podcast_episode_url),
-                ("EnqueuedURIMetaData", metadata),
-                ("DesiredFirstTrackNumberEnqueued", 0),
-                ("EnqueueAsNext", 0),
-            ])
-            count += 1
         sonos.play_from_queue(0, start=True)
-        return ({"status": "NRK podcast-avspilling startet", "antall_episoder": count}, 200)
+        return ({"status": "NRK podcast-avspilling startet", "antall_episoder": enqueue["enqueued"],
+                 "enqueue": enqueue}, 200)
     except Exception as e:
         return ({"error": str(e)}, 500)
 
 # ---------- Stream ----------
-def _resolve_stream_url(uri: str, timeout=6) -> tuple[str, str]:
-    """Følg .pls/.m3u(.8) og HTTP-redirects. Returner (final_url, content_type_lc)."""
-    low = uri.lower()
-    if low.endswith((".pls", ".m3u", ".m3u8")):
-        r = requests.get(uri, timeout=timeout)
-        r.raise_for_status()
-        for line in r.text.splitlines():
-            s = line.strip()
-            if not s or s.startswith("#"):
-                continue
-            if s.startswith("http://") or s.startswith("https://"):
-                uri = s
+STREAM_PROBE_BYTES = 12288          # samme vindu som de tre gamle Range-kallene (0/4096/8192)
+STREAM_PLAYLIST_MAX_BYTES = 262144
+STREAM_PLAYLIST_MAX_DEPTH = 4       # .pls -> master.m3u8 -> media.m3u8 osv.
+_PLAYLIST_CTYPES = (
+    "audio/x-mpegurl", "audio/mpegurl", "application/vnd.apple.mpegurl",
+    "application/x-mpegurl", "audio/x-scpls", "application/pls+xml",
+)
+
+def _read_upto(resp, limit):
+    buf = b""
+    for chunk in resp.iter_content(chunk_size=4096):
+        buf += chunk
+        if len(buf) >= limit:
+            break
+    return buf[:limit]
+
+_icy_hosts = set()  # (host, port) som har svart "ICY 200 OK"; probes rått direkte neste gang
+
+def _icy_host(uri):
+    parts = urllib.parse.urlsplit(uri)
+    return parts.hostname, parts.port or (443 if parts.scheme == "https" else 80)
+
+def _probe_icy(uri: str, timeout=6) -> dict:
+    """
+    Shoutcast v1 svarer "ICY 200 OK", som http.client avviser. Les svaret
+    rått over én tilkobling: icy-*/content-type-headere og de første bytene.
+    """
+    parts = urllib.parse.urlsplit(uri)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    raw = b""
+    with contextlib.ExitStack() as stack:
+        sock = stack.enter_context(socket.create_connection((parts.hostname, port), timeout=timeout))
+        if parts.scheme == "https":
+            # wrap_socket overtar fd-en; SSL-socketen må lukkes selv
+            sock = stack.enter_context(
+                ssl.create_default_context().wrap_socket(sock, server_hostname=parts.hostname))
+        sock.sendall((f"GET {path} HTTP/1.0\r\nHost: {parts.netloc}\r\n"
+                      "User-Agent: sonos-remotes\r\nAccept: */*\r\n\r\n").encode("latin-1"))
+        while b"\r\n\r\n" not in raw or len(raw.split(b"\r\n\r\n", 1)[1]) < STREAM_PROBE_BYTES:
+            chunk = sock.recv(4096)
+            if not chunk:
                 break
+            raw += chunk
+            if b"\r\n\r\n" not in raw and len(raw) > 65536:
+                break
+    head, _, body = raw.partition(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    if not lines[0].startswith("ICY 200"):
+        raise ValueError(f"Uventet svar fra strømmen: {lines[0][:80]}")
+    headers = {}
+    for line in lines[1:]:
+        key, sep, value = line.partition(":")
+        if sep:
+            headers[key.strip().lower()] = value.strip()
+    icy = {"protocol": "ICY", **{k: v for k, v in headers.items() if k.startswith("icy-")}}
+    ctype = headers.get("content-type", "").split(";")[0].strip().lower()
+    return {"uri": uri, "ctype": ctype, "sniff": _classify_audio_bytes(body[:STREAM_PROBE_BYTES]), "icy": icy}
+
+def _parse_playlist(text: str, base_url: str):
+    """
+    Returner ("hls_media", url) for en HLS media-spilleliste, ("hls_master", variant)
+    for en HLS master, ("entry", url) for vanlig .pls/.m3u, ellers (None, None).
+    """
+    lines = [l.strip() for l in text.splitlines() if l.strip()]
+    if any(l.startswith("#EXT-X-") for l in lines):
+        expect_variant = False
+        for l in lines:
+            if l.startswith("#EXT-X-STREAM-INF"):
+                expect_variant = True
+            elif expect_variant and not l.startswith("#"):
+                # Første variant er standardvalget i HLS
+                return "hls_master", urllib.parse.urljoin(base_url, l)
+        return "hls_media", base_url
+    for l in lines:
+        if l.startswith(("#", "[")):
+            continue
+        m = re.match(r"^File\d+\s*=\s*(.+)$", l, re.IGNORECASE)
+        if m:
+            l = m.group(1).strip()
+        if l.startswith("http://") or l.startswith("https://"):
+            return "entry", l
+    return None, None
+
+def _probe_stream(uri: str, timeout=6) -> dict:
+    """
+    Én GET per nivå: følg redirects og .pls/.m3u/HLS-spillelister (også nestede
+    .m3u8), les kun de første bytene av lydstrømmen og klassifiser ut fra
+    headere + bytes. Returnerer {uri, ctype, sniff, icy}.
+    """
+    icy = None
+    for _ in range(STREAM_PLAYLIST_MAX_DEPTH):
+        if _icy_host(uri) in _icy_hosts:
+            return _probe_icy(uri, timeout)
+        try:
+            resp = http_get(uri, session=probe_session, stream=True, allow_redirects=True, timeout=timeout)
+        except requests.exceptions.ConnectionError as e:
+            # Shoutcast v1 svarer "ICY 200 OK", som http.client ikke godtar som statuslinje
+            if "ICY" in str(e):
+                # Bruk URL-en som faktisk svarte ICY (etter redirects), ikke den vi startet med
+                icy_uri = getattr(e.request, "url", None) or uri
+                _icy_hosts.add(_icy_host(icy_uri))
+                return _probe_icy(icy_uri, timeout)
+            raise
+        with resp:
+            resp.raise_for_status()
+            final = resp.url
+            ctype = (resp.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+            icy_headers = {k.lower(): v for k, v in resp.headers.items() if k.lower().startswith("icy-")}
+            if icy_headers:
+                icy = icy_headers
+            buf = _read_upto(resp, STREAM_PROBE_BYTES)
+            path = urllib.parse.urlsplit(final).path.lower()
+            is_playlist = (
+                ctype in _PLAYLIST_CTYPES
+                or path.endswith((".pls", ".m3u", ".m3u8"))
+                or buf.lstrip().startswith((b"#EXTM3U", b"[playlist]"))
+            )
+            if is_playlist and len(buf) >= STREAM_PROBE_BYTES:
+                buf += _read_upto(resp, STREAM_PLAYLIST_MAX_BYTES - len(buf))
 
-    # HEAD for å finne endelig URL + Content-Type (fall back til GET om HEAD feiler)
-    try:
-        h = requests.head(uri, allow_redirects=True, timeout=timeout)
-        final = h.url
-        ctype = (h.headers.get("Content-Type") or "").split(";")[0].strip().lower()
-    except Exception:
-        g = requests.get(uri, allow_redirects=True, timeout=timeout)
-        final = g.url
-        ctype = (g.headers.get("Content-Type") or "").split(";")[0].strip().lower()
-    return final, ctype
+        if not is_playlist:
+            return {"uri": final, "ctype": ctype, "sniff": _classify_audio_bytes(buf), "icy": icy}
+
+        kind, target = _parse_playlist(buf.decode("utf-8", errors="replace"), final)
+        if kind == "hls_media":
+            return {"uri": final, "ctype": ctype, "sniff": "hls", "icy": icy}
+        if not target:
+            raise ValueError("Fant ingen strøm-URL i spillelisten")
+        uri = target
+    raise ValueError("For mange nestede spillelister")
 
 def _didl_for_stream(title: str, uri: str, mime: str) -> str:
     # NB: bruker saxutils.escape fra din eksisterende import
@@ -430,103 +1714,816 @@ def _didl_for_stream(title: str, uri: str, mime: str) -> str:
         '</DIDL-Lite>'
     )
 
-def _sniff_magic(uri: str, timeout=6) -> str | None:
+def _classify_audio_bytes(buf: bytes) -> str | None:
     """
-    Returner 'ogg_vorbis' | 'ogg_opus' | 'mp3' | 'aac' | None
+    Returner 'ogg_vorbis' | 'ogg_opus' | 'ogg' | 'mp3' | 'aac' | None ut fra
+    de første bytene, vurdert i vinduer på 4096 byte.
     """
-    try:
-        for start in (0, 4096, 8192):
-            r = requests.get(
-                uri,
-                headers={"Range": f"bytes={start}-{start+4095}"},
-                stream=True, allow_redirects=True, timeout=timeout
-            )
-            r.raise_for_status()
-            chunk = next(r.iter_content(chunk_size=4096), b"")
-            if not chunk:
-                continue
+    for start in (0, 4096, 8192):
+        chunk = buf[start:start + 4096]
+        if not chunk:
+            continue
 
-            head = chunk[:64]
+        head = chunk[:64]
 
-            # Ogg container
-            if b"OggS" in chunk:
-                if b"OpusHead" in chunk:
-                    return "ogg_opus"
-                if b"vorbis" in chunk:
-                    return "ogg_vorbis"
-                return "ogg"
+        # Ogg container
+        if b"OggS" in chunk:
+            if b"OpusHead" in chunk:
+                return "ogg_opus"
+            if b"vorbis" in chunk:
+                return "ogg_vorbis"
+            return "ogg"
 
-            # MP3: ID3 header eller MPEG frame sync 0xFFEx
-            if head.startswith(b"ID3") or (len(head) >= 2 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0):
-                return "mp3"
+        # MP3: ID3 header eller MPEG frame sync 0xFFEx
+        if head.startswith(b"ID3") or (len(head) >= 2 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0):
+            return "mp3"
 
-            # AAC (ADTS): sync 0xFFF1 eller 0xFFF9
-            if len(head) >= 2 and head[0] == 0xFF and head[1] in (0xF1, 0xF9):
-                return "aac"
+        # AAC (ADTS): sync 0xFFF1 eller 0xFFF9
+        if len(head) >= 2 and head[0] == 0xFF and head[1] in (0xF1, 0xF9):
+            return "aac"
 
-            # MP4/AAC-in-ISO (m4a/mp4) – grov sniff
-            if b"ftypM4A" in head or b"mp42" in head or b"isom" in head:
-                return "aac"
-    except Exception:
-        pass
+        # MP4/AAC-in-ISO (m4a/mp4) – grov sniff
+        if b"ftypM4A" in head or b"mp42" in head or b"isom" in head:
+            return "aac"
     return None
 
-def svc_play_stream(device_id: str, uri: str):
+# Cache for stream-oppløsning: input-URI -> endelig URL, content-type, sniff,
+# valgt MIME og modusen som sist fungerte. Treff = kun selve avspillingen.
+# Feiler avspilling med cachede parametre, kastes oppføringen og vi løser på nytt.
+STREAM_CACHE_TTL = int(os.environ.get("SOCORFID_STREAM_TTL", str(6 * 3600)))
+_stream_cache = {}
+_stream_cache_lock = threading.Lock()
+_stream_stats = {"hits": 0, "misses": 0, "invalidated": 0}
+
+def _stream_cache_get(uri):
+    with _stream_cache_lock:
+        entry = _stream_cache.get(uri)
+        if entry and time.time() - entry["cached_at"] < STREAM_CACHE_TTL:
+            _stream_stats["hits"] += 1
+            return dict(entry)
+        _stream_cache.pop(uri, None)
+        _stream_stats["misses"] += 1
+        return None
+
+def _stream_cache_put(uri, plan):
+    with _stream_cache_lock:
+        _stream_cache[uri] = {**plan, "cached_at": time.time()}
+
+def _stream_cache_invalidate(uri):
+    with _stream_cache_lock:
+        if _stream_cache.pop(uri, None) is not None:
+            _stream_stats["invalidated"] += 1
+
+def stream_cache_stats():
+    with _stream_cache_lock:
+        return {**_stream_stats, "entries": len(_stream_cache), "ttl_s": STREAM_CACHE_TTL}
+
+def _resolve_stream_plan(uri, fallback=True):
+    """
+    Prob strømmen og velg MIME. Feiler proben (HTTP-feil, nettverk) og fallback
+    er på, spilles original-URI-en med standard-MIME, slik Sonos ofte klarer
+    likevel (f.eks. CDN-er som avviser vår User-Agent); planen får da probe_error.
+    """
+    job_stage("resolve")
+    t0 = time.monotonic()
+    try:
+        probe = _probe_stream(uri)
+        probe_error = None
+    except Exception as e:
+        if not fallback:
+            raise
+        print(f"Kunne ikke probe {uri}, spiller med standard-MIME:", e)
+        probe = {"uri": uri, "ctype": "", "sniff": None, "icy": None}
+        probe_error = str(e)
+    final_uri, ctype = probe["uri"], probe["ctype"]
+    ulow = final_uri.lower()
+
+    kind = probe["sniff"]  # 'mp3' | 'aac' | 'ogg_vorbis' | 'ogg_opus' | 'ogg' | 'hls' | None
+
+    # Bestem MIME vi vil annonsere i DIDL (behold 'aacp' hvis vi ser det)
+    decided_mime = None
+    if kind == "hls":
+        decided_mime = "application/vnd.apple.mpegurl"
+    elif kind in ("ogg_vorbis",) or "ogg" in ctype or ulow.endswith(".ogg"):
+        decided_mime = "application/ogg"
+    elif kind == "aac" or "aac" in ctype or ulow.endswith((".aac", ".m4a", ".mp4")):
+        decided_mime = "audio/aacp" if "aacp" in ctype else "audio/aac"
+    elif kind == "mp3" or "mpeg" in ctype or "mp3" in ctype or ulow.endswith(".mp3"):
+        decided_mime = "audio/mpeg"
+    elif ctype in ("", "application/octet-stream"):
+        decided_mime = "audio/mpeg"   # safe default
+    else:
+        decided_mime = ctype
+    return {"uri": final_uri, "ctype": ctype, "sniff": kind, "decided_mime": decided_mime,
+            "icy": probe["icy"], "probe_ms": int((time.monotonic() - t0) * 1000), "probe_error": probe_error}
+
+def _play_stream_mode(sonos, plan, mode):
+    final_uri = plan["uri"]
+    if mode == "radio":
+        sonos.play_uri(f"x-rincon-mp3radio://{final_uri}")
+    elif mode == "queue+didl":
+        meta = _didl_for_stream("Internet Radio", final_uri, plan["decided_mime"])
+        _add_uri_to_queue(sonos, final_uri, meta)
+        sonos.play_from_queue(0, start=True)
+    else:
+        sonos.play_uri(final_uri)
+
+def _play_stream_plan(sonos, plan):
+    """Prøv modusene i prioritert rekkefølge og returner den som fungerte."""
+    if plan["uri"].startswith(("http://", "https://")):
+        # HTTP(S) – prøv radio-modus for MP3 **og AAC** først
+        if plan["decided_mime"] in ("audio/mpeg", "audio/aac", "audio/aacp"):
+            try:
+                _play_stream_mode(sonos, plan, "radio")
+                return "radio"
+            except Exception:
+                pass  # fall back til queue + DIDL
+        # For Ogg/AAC/annet: queue + DIDL
+        _play_stream_mode(sonos, plan, "queue+didl")
+        return "queue+didl"
+    # Ikke-HTTP: direkte
+    _play_stream_mode(sonos, plan, "direct")
+    return "direct"
+
+_STREAM_MODE_LABELS = {"radio": "radio mode, {mime}", "queue+didl": "queue + DIDL, {mime}", "direct": "direct"}
+
+def _stream_response(plan, mode, cached):
+    label = _STREAM_MODE_LABELS[mode].format(mime=plan["decided_mime"])
+    return ({"status": f"Avspilling startet ({label})",
+             "uri": plan["uri"], "ctype": plan["ctype"], "sniff": plan["sniff"],
+             "decided_mime": plan["decided_mime"], "mode": mode, "cached": cached,
+             "icy": plan.get("icy"), "probe_ms": plan.get("probe_ms"),
+             "probe_error": plan.get("probe_error")}, 200)
+
+def svc_play_stream(device_id: str, uri: str, plan=None):
     ip, err = _require_speaker_ip(device_id)
     if err: return err
     try:
-        final_uri, ctype = _resolve_stream_url(uri)
-        ctype = (ctype or "").lower()
-        ulow = final_uri.lower()
-
-        kind = _sniff_magic(final_uri)  # 'mp3' | 'aac' | 'ogg_vorbis' | 'ogg_opus' | None
-
-        # Bestem MIME vi vil annonsere i DIDL (behold 'aacp' hvis vi ser det)
-        decided_mime = None
-        if kind in ("ogg_vorbis",) or "ogg" in ctype or ulow.endswith(".ogg"):
-            decided_mime = "application/ogg"
-        elif kind == "aac" or "aac" in ctype or ulow.endswith((".aac", ".m4a", ".mp4")):
-            decided_mime = "audio/aacp" if "aacp" in ctype else "audio/aac"
-        elif kind == "mp3" or "mpeg" in ctype or "mp3" in ctype or ulow.endswith(".mp3"):
-            decided_mime = "audio/mpeg"
-        elif ctype in ("", "application/octet-stream"):
-            decided_mime = "audio/mpeg"   # safe default
-        else:
-            decided_mime = ctype
+        cached = _stream_cache_get(uri)
+        if cached:
+            sonos = _prepare_sonos(ip)
+            try:
+                _play_stream_mode(sonos, cached, cached["mode"])
+                return _stream_response(cached, cached["mode"], True)
+            except Exception as e:
+                print(f"Cachet stream-oppsett for {uri} feilet, løser på nytt:", e)
+                _stream_cache_invalidate(uri)
 
+        plan = plan or _resolve_stream_plan(uri)  # forhåndsbygd plan slipper probing
         sonos = _prepare_sonos(ip)
+        mode = _play_stream_plan(sonos, plan)
+        if not plan.get("probe_error"):
+            _stream_cache_put(uri, {**plan, "mode": mode})  # en mislykket probe skal prøves på nytt
+        return _stream_response(plan, mode, False)
 
-        # HTTP(S) – prøv radio-modus for MP3 **og AAC** først
-        if final_uri.startswith(("http://", "https://")):
-            if decided_mime in ("audio/mpeg", "audio/aac", "audio/aacp"):
-                try:
-                    sonos.play_uri(f"x-rincon-mp3radio://{final_uri}")
-                    return ({"status": f"Avspilling startet (radio mode, {decided_mime})",
-                             "uri": final_uri, "ctype": ctype, "sniff": kind, "decided_mime": decided_mime, "mode": "radio"}, 200)
-                except Exception:
-                    pass  # fall back til queue + DIDL
-
-            # For Ogg/AAC/annet: queue + DIDL
-            meta = _didl_for_stream("Internet Radio", final_uri, decided_mime)
-            sonos.avTransport.AddURIToQueue([
+    except Exception as e:
+        return ({"error": str(e)}, 500)
+
+# ---------- Allerede lastet kort ----------
+# Per høyttaler huskes hvilket kort som sist ble lastet: et fingeravtrykk av
+# kort og mapping, pluss det høyttaleren rapporterte rett etterpå (kilde-URI,
+# første kø-element og køens lengde). Skannes samme kort igjen og høyttaleren
+# fortsatt har det samme, gjenopptas avspillingen i stedet for å bygge køen på nytt.
+_loaded_cards = {}  # ip -> {"fingerprint", "card_id", "uri", "first_uri", "queue_size", "fill_started", "loaded_at"}
+_loaded_cards_lock = threading.Lock()
+# Egen pool: tilstandslesingen venter selv på kall i _speaker_io_pool
+_loaded_card_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="loaded-card")
+
+def _card_fingerprint(card_id, mapping):
+    raw = json.dumps([card_id, mapping.get("type"), mapping.get("media")], ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def forget_loaded_card(ip):
+    with _loaded_cards_lock:
+        _loaded_cards.pop(ip, None)
+
+def _record_loaded_card(ip, card_id, fingerprint, fill_started):
+    try:
+        state = speaker_state(ip, max_age=0)
+    except Exception as e:
+        print("Kunne ikke lese tilstand etter avspilling:", e)
+        return
+    with _loaded_cards_lock:
+        _loaded_cards[ip] = {
+            "fingerprint": fingerprint,
+            "card_id": card_id,
+            "uri": state["uri"],
+            "first_uri": state["first_uri"],
+            "queue_size": state["queue_size"],
+            "fill_started": fill_started,
+            "loaded_at": time.time(),
+        }
+
+def remember_loaded_card(device_id, card_id, mapping, fill=None):
+    """
+    Registrer kortet som lastet (leser tilstanden i bakgrunnen). fill er
+    påfyllet denne avspillingen startet (fra svaret), ellers None.
+    """
+    ip = get_speaker_for_device(device_id)
+    if ip:
+        _loaded_card_pool.submit(_record_loaded_card, ip, card_id, _card_fingerprint(card_id, mapping),
+                                 fill["started_at"] if fill else None)
+
+def _loaded_fill_ok(ip, loaded):
+    """Køen er komplett eller på vei: kortets påfyll kjører fortsatt eller ble ferdig."""
+    if loaded["fill_started"] is None:
+        return True
+    fill = queue_fill_status(ip)
+    return (fill is not None and fill["started_at"] == loaded["fill_started"]
+            and fill["state"] in ("running", "done"))
+
+def svc_resume_loaded_card(device_id: str, card_id: str, mapping: dict, restart=False):
+    """
+    Gjenoppta avspilling hvis kortet allerede er lastet på høyttaleren.
+    Returnerer (body, code), eller None når køen må bygges på nytt.
+    """
+    ip = get_speaker_for_device(device_id)
+    if not ip:
+        return None
+    with _loaded_cards_lock:
+        loaded = _loaded_cards.get(ip)
+    if not loaded or loaded["fingerprint"] != _card_fingerprint(card_id, mapping):
+        return None
+    if not _loaded_fill_ok(ip, loaded):
+        # Et vindu som er utløpt eller et påfyll som feilet gir en avkortet kø
+        return None
+    try:
+        state = speaker_state(ip)
+        if state["uri"] != loaded["uri"]:
+            return None
+        from_queue = state["uri"].startswith("x-rincon-queue:")
+        # Påfyll kan ha gjort køen lengre, men aldri kortere eller med annen start
+        if from_queue and (state["first_uri"] != loaded["first_uri"]
+                           or state["queue_size"] < loaded["queue_size"]):
+            return None
+        if restart and from_queue:
+            speaker_soap(ip, "avTransport", "Seek", [("InstanceID", 0), ("Unit", "TRACK_NR"), ("Target", 1)])
+        if restart or state["transport"] != "PLAYING":
+            speaker_soap(ip, "avTransport", "Play", [("InstanceID", 0), ("Speed", 1)])
+            action = "restarted" if restart else "resumed"
+        else:
+            action = "already_playing"
+        invalidate_speaker_state(ip)
+    except Exception as e:
+        print("Kunne ikke gjenbruke lastet kø, bygger på nytt:", e)
+        return None
+    return ({"status": "Kortet er allerede lastet, avspilling gjenopptatt",
+             "card_id": card_id, "reused": True, "action": action,
+             "loaded_at": loaded["loaded_at"]}, 200)
+
+# ---------- Kort som Sonos-spillelister ----------
+# program- og podcast-kort kan kompileres én gang til en lagret Sonos-spilleliste
+# (SQ:n) i husstanden. Skanning legger da bare spillelisten i køen i stedet for
+# dusinvis av enkeltelementer. Spillelisten bygges i bakgrunnen første gang
+# (skanningen spilles på vanlig måte imens), og sjekkes mot kilden etter avspilling
+# når det er gått CARD_PLAYLIST_RECHECK sekunder. Slå på med SOCORFID_CARD_PLAYLISTS=1
+# eller "playlist": true i /play_by_card. Oversikt og opprydding: /playlists.
+CARD_PLAYLISTS = os.environ.get("SOCORFID_CARD_PLAYLISTS", "0") == "1"
+CARD_PLAYLIST_PREFIX = "RFID "  # navneprefiks for appens spillelister (eierskap står i owned_playlists)
+CARD_PLAYLIST_RECHECK = int(os.environ.get("SOCORFID_PLAYLIST_RECHECK", "600"))
+_card_playlist_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="card-playlist")  # én endring av gangen
+_card_playlist_building = set()
+_card_playlist_lock = threading.Lock()
+
+def _card_playlist_get(card_id):
+    row = _db().execute("SELECT * FROM card_playlists WHERE card_id = ?", (card_id,)).fetchone()
+    return dict(row) if row else None
+
+def _card_playlist_all():
+    return [dict(r) for r in _db().execute("SELECT * FROM card_playlists ORDER BY card_id").fetchall()]
+
+def _card_playlist_put(row):
+    with _db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO card_playlists "
+            "(card_id, fingerprint, playlist_id, title, signature, items, built_at, checked_at) "
+            "VALUES (:card_id, :fingerprint, :playlist_id, :title, :signature, :items, :built_at, :checked_at)",
+            row,
+        )
+
+def _card_playlist_touch(card_id):
+    with _db() as conn:
+        conn.execute("UPDATE card_playlists SET checked_at = ? WHERE card_id = ?", (time.time(), card_id))
+
+def _card_playlist_delete(card_id):
+    with _db() as conn:
+        conn.execute("DELETE FROM card_playlists WHERE card_id = ?", (card_id,))
+
+def _card_playlist_items(mapping):
+    """(uri, didl)-iterator for kort som kan bli spilleliste, ellers None."""
+    media = mapping.get("media") or ""
+    if mapping.get("type") == "program":
+        return _iter_nrk_series_queue(media)
+    if mapping.get("type") == "podcast" and not _PODCAST_EPISODE_URL.match(media):
+        return _iter_feed_episodes(os.path.join(PODCAST_FEED_DIR, media))
+    return None
+
+def _playlist_uri(playlist_id):
+    return f"file:///jffs/settings/savedqueues.rsq#{playlist_id.split(':', 1)[1]}"
+
+def _didl_for_playlist(playlist_id, title):
+    return (
+        '<DIDL-Lite xmlns:dc="http://purl.org/dc/elements/1.1/" '
+        'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" '
+        'xmlns:r="urn:schemas-rinconnetworks-com:metadata-1-0/" '
+        'xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/">'
+        f'<container id="{saxutils.escape(playlist_id)}" parentID="SQ:" restricted="true">'
+        f'<dc:title>{saxutils.escape(title)}</dc:title>'
+        '<upnp:class>object.container.playlistContainer</upnp:class>'
+        f'<res protocolInfo="x-rincon-playlist:*:*:*">{saxutils.escape(_playlist_uri(playlist_id))}</res>'
+        '</container>'
+        '</DIDL-Lite>'
+    )
+
+def _owned_playlists():
+    """{id: tittel} for spillelister appen selv har opprettet og ikke slettet."""
+    return {r["playlist_id"]: r["title"] for r in _db().execute("SELECT playlist_id, title FROM owned_playlists")}
+
+def _own_playlist(playlist_id, title):
+    with _db() as conn:
+        conn.execute("INSERT OR REPLACE INTO owned_playlists (playlist_id, title, created_at) VALUES (?, ?, ?)",
+                     (playlist_id, title, time.time()))
+
+def _disown_playlist(playlist_id):
+    with _db() as conn:
+        conn.execute("DELETE FROM owned_playlists WHERE playlist_id = ?", (playlist_id,))
+
+def _destroy_playlist(ip, playlist_id):
+    speaker_soap(ip, "contentDirectory", "DestroyObject", [("ObjectID", playlist_id)])
+    _disown_playlist(playlist_id)
+
+def _list_sonos_playlists(ip):
+    """{id: tittel} for alle lagrede spillelister i husstanden."""
+    playlists = {}
+    start = 0
+    while True:
+        resp = speaker_soap(ip, "contentDirectory", "Browse", [
+            ("ObjectID", "SQ:"),
+            ("BrowseFlag", "BrowseDirectChildren"),
+            ("Filter", "dc:title"),
+            ("StartingIndex", start),
+            ("RequestedCount", 100),
+            ("SortCriteria", ""),
+        ])
+        returned = int(resp.get("NumberReturned") or 0)
+        if resp.get("Result"):
+            for el in ET.fromstring(resp["Result"]):
+                title = el.findtext("{http://purl.org/dc/elements/1.1/}title") or ""
+                playlists[el.get("id")] = title
+        start += returned
+        if not returned or start >= int(resp.get("TotalMatches") or 0):
+            return playlists
+
+def _compile_card_playlist(ip, card_id, mapping, force=False):
+    items = _card_playlist_items(mapping)
+    if items is None:
+        raise ValueError("Kortet kan ikke lagres som spilleliste")
+    items = list(items)
+    if not items:
+        raise ValueError("Ingen elementer å lage spilleliste av")
+    signature = hashlib.sha1("\n".join(uri for uri, _ in items).encode("utf-8")).hexdigest()
+    fingerprint = _card_fingerprint(card_id, mapping)
+    row = _card_playlist_get(card_id)
+    if row and not force and row["fingerprint"] == fingerprint and row["signature"] == signature:
+        _card_playlist_touch(card_id)
+        return row
+
+    title = f"{CARD_PLAYLIST_PREFIX}{card_id}"
+    created = speaker_soap(ip, "avTransport", "CreateSavedQueue", [
+        ("InstanceID", 0), ("Title", title), ("EnqueuedURI", ""), ("EnqueuedURIMetaData", ""),
+    ])
+    playlist_id = created["AssignedObjectID"]
+    _own_playlist(playlist_id, title)
+    try:
+        update_id = created.get("NewUpdateID") or 0
+        for uri, metadata in items:
+            resp = speaker_soap(ip, "avTransport", "AddURIToSavedQueue", [
                 ("InstanceID", 0),
-                ("EnqueuedURI", final_uri),
-                ("EnqueuedURIMetaData", meta),
-                ("DesiredFirstTrackNumberEnqueued", 0),
-                ("EnqueueAsNext", 0),
+                ("UpdateID", update_id),
+                ("ObjectID", playlist_id),
+                ("EnqueuedURI", uri),
+                ("EnqueuedURIMetaData", metadata),
+                ("AddAtIndex", 4294967295),  # på slutten
             ])
-            sonos.play_from_queue(0, start=True)
-            return ({"status": f"Avspilling startet (queue + DIDL, {decided_mime})",
-                     "uri": final_uri, "ctype": ctype, "sniff": kind, "decided_mime": decided_mime, "mode": "queue+didl"}, 200)
+            update_id = resp.get("NewUpdateID", update_id)
+    except Exception:
+        _destroy_playlist(ip, playlist_id)  # ingen halvferdige spillelister
+        raise
+    now = time.time()
+    new_row = {"card_id": card_id, "fingerprint": fingerprint, "playlist_id": playlist_id,
+               "title": title, "signature": signature, "items": len(items),
+               "built_at": now, "checked_at": now}
+    _card_playlist_put(new_row)
+    if row:
+        try:
+            _destroy_playlist(ip, row["playlist_id"])
+        except Exception as e:
+            print(f"Kunne ikke slette gammel spilleliste {row['playlist_id']}:", e)
+    print(f"Spilleliste {playlist_id} bygget for kort {card_id} ({len(items)} elementer)")
+    return new_row
 
-        # Ikke-HTTP: direkte
-        sonos.play_uri(final_uri)
-        return ({"status": "Avspilling startet (direct)",
-                 "uri": final_uri, "ctype": ctype, "sniff": kind, "decided_mime": decided_mime, "mode": "direct"}, 200)
+def _card_playlist_job(ip, card_id, mapping, force):
+    try:
+        _compile_card_playlist(ip, card_id, mapping, force=force)
+    except Exception as e:
+        print(f"Feil ved bygging av spilleliste for kort {card_id}:", e)
+    finally:
+        with _card_playlist_lock:
+            _card_playlist_building.discard(card_id)
+
+def schedule_card_playlist(ip, card_id, mapping, force=False):
+    """Bygg eller sjekk kortets spilleliste i bakgrunnen (maks én jobb per kort)."""
+    with _card_playlist_lock:
+        if card_id in _card_playlist_building:
+            return False
+        _card_playlist_building.add(card_id)
+    _card_playlist_pool.submit(_card_playlist_job, ip, card_id, mapping, force)
+    return True
+
+def svc_play_card_playlist(device_id: str, card_id: str, mapping: dict):
+    """
+    Spill kortets lagrede spilleliste. Returnerer (body, code), eller None når
+    kortet må spilles på vanlig måte (spillelisten bygges da i bakgrunnen).
+    """
+    ip = get_speaker_for_device(device_id)
+    if not ip or _card_playlist_items(mapping) is None:
+        return None
+    row = _card_playlist_get(card_id)
+    if not row or row["fingerprint"] != _card_fingerprint(card_id, mapping):
+        schedule_card_playlist(ip, card_id, mapping)
+        return None
+    try:
+        sonos = _prepare_sonos(ip)
+        _add_uri_to_queue(sonos, _playlist_uri(row["playlist_id"]), _didl_for_playlist(row["playlist_id"], row["title"]))
+        sonos.play_from_queue(0, start=True)
+    except Exception as e:
+        # Spillelisten er trolig slettet i Sonos-appen; bygg den på nytt
+        print(f"Spilleliste {row['playlist_id']} for kort {card_id} feilet:", e)
+        _card_playlist_delete(card_id)
+        schedule_card_playlist(ip, card_id, mapping)
+        return None
+    if time.time() - row["checked_at"] > CARD_PLAYLIST_RECHECK:
+        schedule_card_playlist(ip, card_id, mapping)
+    return ({"status": "Avspilling startet fra lagret spilleliste", "playlist": row["title"],
+             "playlist_id": row["playlist_id"], "antall_episoder": row["items"],
+             "built_at": row["built_at"]}, 200)
+
+def svc_card_playlists(device_id=None, collect=False, destroy=()):
+    """
+    Spillelister appen eier, med status: ok, stale (kort borte/endret, eller
+    opprettet av appen uten kort), missing (slettet på Sonos) eller orphan
+    (prefiks-navn appen ikke har opprettet). collect=True sletter stale og
+    glemmer missing; orphan slettes bare når ID-en står i destroy.
+    """
+    ip = get_speaker_for_device(device_id) if device_id else None
+    if not ip:
+        zones = get_topology()["zones"]
+        ip = next(iter(zones)).ip_address if zones else None
+    if not ip:
+        return ({"error": "Fant ingen høyttaler å spørre"}, 400)
+    try:
+        on_sonos = _list_sonos_playlists(ip)
+        rows = {r["playlist_id"]: r for r in _card_playlist_all()}
+        owned = _owned_playlists()
+        cards = all_cards()
+        destroy = set(destroy)
+        result = []
+        candidates = set(rows) | set(owned) | {pid for pid, t in on_sonos.items() if t.startswith(CARD_PLAYLIST_PREFIX)}
+        for playlist_id in sorted(candidates):
+            row = rows.get(playlist_id)
+            if playlist_id not in on_sonos:
+                status = "missing"
+            elif playlist_id not in owned:
+                # Samme prefiks, men ikke opprettet her (brukerens egen, annen instans, nullstilt DB)
+                status = "orphan"
+            elif row is None:
+                status = "stale"  # vår, men ikke lenger knyttet til et kort
+            elif row["card_id"] not in cards or row["fingerprint"] != _card_fingerprint(row["card_id"], cards[row["card_id"]]):
+                status = "stale"
+            else:
+                status = "ok"
+            title = on_sonos.get(playlist_id) or (row["title"] if row else owned.get(playlist_id))
+            entry = {"playlist_id": playlist_id, "title": title, "status": status}
+            if row:
+                entry.update(card_id=row["card_id"], items=row["items"],
+                             built_at=row["built_at"], checked_at=row["checked_at"])
+            removed = False
+            if collect and status == "stale":
+                _destroy_playlist(ip, playlist_id)
+                removed = True
+            elif collect and status == "missing":
+                _disown_playlist(playlist_id)
+                removed = True
+            elif status == "orphan" and playlist_id in destroy:
+                _destroy_playlist(ip, playlist_id)
+                removed = True
+            if removed:
+                if row:
+                    _card_playlist_delete(row["card_id"])
+                entry["removed"] = True
+            result.append(entry)
+        return ({"playlists": result}, 200)
+    except Exception as e:
+        return ({"error": str(e)}, 500)
+
+# ---------- Forhåndsbygde avspillingsplaner ----------
+# En bakgrunnstråd holder en ferdig plan per kort: ordnede (uri, didl)-par for
+# program/podcast, eller et løst stream-oppsett. Skanning bruker planen direkte,
+# så NRK-kjeden, feed-XML og stream-probing ikke skjer mens barnet venter.
+# Planer bygges ved oppstart, ved mapping-endringer og når de er eldre enn
+# PLAN_REFRESH_INTERVAL. Oversikt: GET /plans, bygg ett kort: POST /plans/rebuild.
+PLAN_REFRESH_INTERVAL = int(os.environ.get("SOCORFID_PLAN_INTERVAL", "1800"))
+PLAN_CHECK_INTERVAL = 60   # hvor ofte tråden ser etter endrede mappinger
+PLAN_RETRY_DELAY = 300     # vent før et kort som feilet prøves igjen
+PLAN_TYPES = ("program", "podcast", "stream")  # playlink har ingenting å forhåndsberegne
+_card_plans = {}  # card_id -> plan-dict
+_card_plans_lock = threading.Lock()
+_plan_wakeup = threading.Event()
+_plan_thread = None
+
+def _build_card_plan(card_id, mapping):
+    media = mapping.get("media") or ""
+    plan = {"fingerprint": _card_fingerprint(card_id, mapping), "kind": mapping.get("type")}
+    if plan["kind"] == "program":
+        plan["items"] = _build_nrk_series_queue(media)
+    elif plan["kind"] == "podcast":
+        m_ep = _PODCAST_EPISODE_URL.match(media)
+        if m_ep:
+            mp3_url, meta = resolve_podcast_episode(m_ep.group(1), m_ep.group(2), media)
+            plan["items"] = [(mp3_url, _didl_for_podcast_episode(mp3_url, meta))]
+        else:
+            plan["items"] = list(_iter_feed_episodes(os.path.join(PODCAST_FEED_DIR, media)))
+    elif plan["kind"] == "stream":
+        plan["stream"] = _resolve_stream_plan(media, fallback=False)  # ingen plan av en mislykket probe
+    else:
+        raise ValueError(f"Ingen plan for mapping-type {plan['kind']}")
+    if "items" in plan and not plan["items"]:
+        raise ValueError("Fant ingen episoder")
+    return plan
+
+def rebuild_card_plan(card_id, mapping=None):
+    """Bygg kortets plan nå. Feiler byggingen, beholdes forrige plan for samme mapping."""
+    mapping = mapping or get_card(card_id)
+    if mapping is None:
+        raise KeyError(card_id)
+    t0 = time.monotonic()
+    try:
+        plan = _build_card_plan(card_id, mapping)
+        plan.update(built_at=time.time(), build_ms=int((time.monotonic() - t0) * 1000), error=None)
+    except Exception as e:
+        print(f"Feil ved bygging av plan for kort {card_id}:", e)
+        with _card_plans_lock:
+            old = _card_plans.get(card_id)
+        if old and old["fingerprint"] == _card_fingerprint(card_id, mapping):
+            plan = dict(old)
+        else:
+            plan = {"fingerprint": _card_fingerprint(card_id, mapping), "kind": mapping.get("type"),
+                    "built_at": None, "build_ms": None}
+        plan["error"] = str(e)
+    plan["attempted_at"] = time.time()
+    with _card_plans_lock:
+        _card_plans[card_id] = plan
+    return plan
+
+def _plans_due():
+    cards = all_cards()
+    now = time.time()
+    due = []
+    with _card_plans_lock:
+        for card_id in set(_card_plans) - set(cards):
+            del _card_plans[card_id]
+        for card_id, mapping in cards.items():
+            if mapping.get("type") not in PLAN_TYPES:
+                continue
+            plan = _card_plans.get(card_id)
+            if plan is None or plan["fingerprint"] != _card_fingerprint(card_id, mapping):
+                due.append((card_id, mapping))
+            elif plan["error"]:
+                if now - plan["attempted_at"] > PLAN_RETRY_DELAY:
+                    due.append((card_id, mapping))
+            elif now - plan["built_at"] > PLAN_REFRESH_INTERVAL:
+                due.append((card_id, mapping))
+    return due
+
+def _plan_worker():
+    while True:
+        try:
+            for card_id, mapping in _plans_due():
+                rebuild_card_plan(card_id, mapping)
+        except Exception as e:
+            print("Feil i plan-planleggeren:", e)
+        _plan_wakeup.wait(PLAN_CHECK_INTERVAL)
+        _plan_wakeup.clear()
+
+def _ensure_plan_thread():
+    global _plan_thread
+    with _card_plans_lock:
+        if _plan_thread is None:
+            _plan_thread = threading.Thread(target=_plan_worker, name="card-plans", daemon=True)
+            _plan_thread.start()
+
+def request_plan_rebuild():
+    """Vekk planleggeren (f.eks. etter en mapping-endring)."""
+    _ensure_plan_thread()
+    _plan_wakeup.set()
+
+def get_card_plan(card_id, mapping):
+    """Ferdig plan for kortets nåværende mapping, ellers None (og planleggeren vekkes)."""
+    with _card_plans_lock:
+        plan = _card_plans.get(card_id)
+    if plan and plan["fingerprint"] == _card_fingerprint(card_id, mapping) and plan["built_at"]:
+        return plan
+    request_plan_rebuild()
+    return None
 
+def _plan_public(card_id, plan):
+    return {
+        "card_id": card_id,
+        "kind": plan["kind"],
+        "items": len(plan["items"]) if "items" in plan else None,
+        "built_at": plan["built_at"],
+        "age_s": int(time.time() - plan["built_at"]) if plan["built_at"] else None,
+        "build_ms": plan["build_ms"],
+        "error": plan["error"],
+    }
+
+def card_plans_status():
+    with _card_plans_lock:
+        plans = dict(_card_plans)
+    return [_plan_public(card_id, plan) for card_id, plan in sorted(plans.items())]
+
+def svc_play_card_plan(device_id: str, mapping: dict, plan: dict, fast_start=None, lazy=None):
+    if plan["kind"] == "stream":
+        return svc_play_stream(device_id, mapping["media"], plan=plan["stream"])
+    ip, err = _require_speaker_ip(device_id)
+    if err: return err
+    try:
+        items = plan["items"]
+        age_s = int(time.time() - plan["built_at"])
+        lazy = _use_lazy(lazy)
+        sonos = _prepare_sonos(ip)
+        if len(items) > 1 and (lazy or _use_fast_start(fast_start)):
+            fill = _play_first_then_fill(sonos, items[0], items[1:], lazy=lazy)
+            return ({"status": "Avspilling startet fra forhåndsbygd plan (hurtigstart)",
+                     "antall_episoder": fill["enqueued"], "fast_start": True, "fill": fill,
+                     "plan_age_s": age_s}, 200)
+        enqueue = _enqueue_items(sonos, items)
+        sonos.play_from_queue(0, start=True)
+        return ({"status": "Avspilling startet fra forhåndsbygd plan", "antall_episoder": len(items),
+                 "enqueue": enqueue, "plan_age_s": age_s}, 200)
     except Exception as e:
         return ({"error": str(e)}, 500)
 
+CARD_TYPES = ("program", "podcast", "playlink", "stream")
+
+def svc_play_card(device_id: str, card_id: str, mapping: dict, options: dict):
+    """Spill et kort med kjent mapping. options er /play_by_card-bodyen (reuse, playlist, plan, ...)."""
+    # Samme kort som allerede er lastet: gjenoppta i stedet for å bygge køen på nytt
+    if options.get("reuse", True):
+        resumed = svc_resume_loaded_card(device_id, card_id, mapping, restart=bool(options.get("restart")))
+        if resumed:
+            return resumed
+
+    mapping_type = mapping.get("type")
+    media = mapping.get("media")
+
+    fast_start = options.get("fast_start")
+    lazy = options.get("lazy")
+    use_playlist = options.get("playlist")
+    played = None
+    if CARD_PLAYLISTS if use_playlist is None else bool(use_playlist):
+        played = svc_play_card_playlist(device_id, card_id, mapping)
+    if not played and options.get("plan", True) and mapping_type in PLAN_TYPES:
+        plan = get_card_plan(card_id, mapping)
+        if plan:
+            played = svc_play_card_plan(device_id, mapping, plan, fast_start=fast_start, lazy=lazy)
+    if played:
+        body, code = played
+    elif mapping_type == "program":
+        body, code = svc_play_nrk_program(device_id, media, fast_start=fast_start, lazy=lazy)
+    elif mapping_type == "podcast":
+        body, code = svc_play_nrk_podcast(device_id, media, fast_start=fast_start, lazy=lazy)
+    elif mapping_type == "playlink":
+        body, code = svc_play_playlink(device_id, media)
+    elif mapping_type == "stream":
+        body, code = svc_play_stream(device_id, media)
+    else:
+        return ({"error": "Ukjent mapping-type"}, 400)
+
+    if code == 200:
+        remember_loaded_card(device_id, card_id, mapping, fill=body.get("fill"))
+    return body, code
+
+# ---------- Asynkrone avspillingsjobber ----------
+# Med "async": true (eller ?async=1) svarer play-endepunktene 202 med en jobb-id
+# med en gang, og avspillingen kjøres på en arbeiderpool. Klienten (f.eks. en
+# batteridrevet M5) kan legge seg til å sove; status og resultat hentes med
+# GET /jobs/<id> (?wait=N for long-poll). Jobber for samme device_id kjøres
+# etter tur: mens én kjører, holdes bare den nyeste ventende (de eldre hoppes
+# over), og den sendes til poolen når den kjørende er ferdig. Ingen arbeider
+# blokkerer dermed på en annen jobb.
+JOB_WORKERS = int(os.environ.get("SOCORFID_JOB_WORKERS", "4"))
+JOB_TTL = 900          # sekunder en ferdig jobb kan hentes
+JOB_MAX_WAIT = 30      # maks long-poll
+_job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="play-job")
+_jobs = {}             # job_id -> jobb-dict
+_jobs_lock = threading.Lock()
+_running_jobs = {}     # device_id -> job_id som kjører nå
+_pending_jobs = {}     # device_id -> (jobb, fn, args, kwargs) som venter på den kjørende
+_job_local = threading.local()
+
+def job_stage(stage):
+    """Registrer et steg på jobben som kjører i denne tråden (no-op utenfor jobber)."""
+    job = getattr(_job_local, "job", None)
+    if job is not None and job["stage"] != stage:
+        job["stage"] = stage
+        job["stages"].append({"stage": stage, "at": time.time()})
+
+def _job_public(job):
+    return {k: v for k, v in job.items() if k != "done"}
+
+def _purge_jobs():
+    cutoff = time.time() - JOB_TTL
+    with _jobs_lock:
+        for job_id in [j for j, job in _jobs.items() if job["finished_at"] and job["finished_at"] < cutoff]:
+            del _jobs[job_id]
+
+def _supersede_job(job):
+    job.update(state="superseded", finished_at=time.time())
+    job["done"].set()
+
+def _run_job(job, fn, args, kwargs):
+    job.update(state="running", started_at=time.time())
+    _job_local.job = job
+    try:
+        job_stage("start")
+        try:
+            body, code = fn(*args, **kwargs)
+        except Exception as e:
+            body, code = {"error": str(e)}, 500
+        job_stage("done" if code < 400 else "error")
+    finally:
+        _job_local.job = None
+        # Slipp neste ventende jobb for samme device før denne markeres ferdig
+        with _jobs_lock:
+            pending = _pending_jobs.pop(job["device_id"], None)
+            if pending:
+                _running_jobs[job["device_id"]] = pending[0]["id"]
+            else:
+                _running_jobs.pop(job["device_id"], None)
+        if pending:
+            _job_pool.submit(_run_job, *pending)
+    job.update(state="done" if code < 400 else "error", result=body, code=code,
+               finished_at=time.time())
+    job["done"].set()
+
+def submit_job(kind, device_id, fn, *args, **kwargs):
+    """Kjør fn(*args, **kwargs) -> (body, code) som jobb; returnerer jobb-dicten."""
+    _purge_jobs()
+    job = {
+        "id": secrets.token_hex(8),
+        "kind": kind,
+        "device_id": device_id,
+        "state": "queued",
+        "stage": "queued",
+        "stages": [{"stage": "queued", "at": time.time()}],
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "result": None,
+        "code": None,
+        "done": threading.Event(),
+    }
+    replaced = None
+    with _jobs_lock:
+        _jobs[job["id"]] = job
+        start = device_id not in _running_jobs
+        if start:
+            _running_jobs[device_id] = job["id"]
+        else:
+            replaced = _pending_jobs.get(device_id)
+            _pending_jobs[device_id] = (job, fn, args, kwargs)
+    if replaced:
+        _supersede_job(replaced[0])
+    if start:
+        _job_pool.submit(_run_job, job, fn, args, kwargs)
+    return job
+
+def get_job(job_id, wait=0):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is None:
+        return None
+    if wait > 0:
+        job["done"].wait(min(wait, JOB_MAX_WAIT))
+    return _job_public(job)
+
+def jobs_overview(limit=50):
+    with _jobs_lock:
+        jobs = sorted(_jobs.values(), key=lambda j: j["created_at"], reverse=True)[:limit]
+    return [{k: job[k] for k in ("id", "kind", "device_id", "state", "stage", "created_at", "finished_at", "code")}
+            for job in jobs]
+
 # --------------------------
 # LAST RFID-ENDPOINT
 # --------------------------
@@ -534,34 +2531,531 @@ def svc_play_stream(device_id: str, uri: str):
 @require_auth_or_local
 def last_rfid():
     try:
-        with open("last_unmapped_rfid.txt", "r") as f:
-            last = f.read().strip()
-        return jsonify({"last_rfid": last})
+        return jsonify({"last_rfid": db_last_unmapped()})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/unmapped", methods=["GET"])
+@require_auth_or_local
+def unmapped_history():
+    try:
+        limit = max(1, min(int(request.args.get("limit", 50)), 1000))
+    except ValueError:
+        return jsonify({"error": "limit må være et heltall"}), 400
+    try:
+        return jsonify({"scans": db_unmapped_history(limit)})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/state/import", methods=["POST"])
+@require_auth_or_local
+def import_state():
+    global _device_mapping
+    data = request.json or {}
+    try:
+        result = import_json_state(overwrite=bool(data.get("overwrite", False)))
+        # Oppfrisk device-mappingen i minnet med det som nå ligger i lageret
+        flush_mapping()
+        with mapping_lock:
+            _device_mapping = db_load_devices()
+        request_plan_rebuild()
+        return jsonify({"status": "Import fullført", **result})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # --------------------------
 # HENTING AV HØYTTALERE & VALG
 # --------------------------
-def discover_speakers():
-    found = discover()
-    speakers = {}
-    if found:
-        for device in found:
+
+# Topologi-cache: en bakgrunnstråd holder et øyeblikksbilde av soner og grupper
+# i minnet, så endepunktene slipper en full SSDP-runde per kall.
+TOPOLOGY_REFRESH_INTERVAL = int(os.environ.get("SOCORFID_TOPOLOGY_INTERVAL", "300"))
+TOPOLOGY_DISCOVER_TIMEOUT = 3
+# Unicast-gjenoppdagelse: prøv kjente IP-er parallelt før SSDP multicast
+UNICAST_REDISCOVERY = os.environ.get("SOCORFID_UNICAST_REDISCOVERY", "1") != "0"
+UNICAST_PROBE_TIMEOUT = float(os.environ.get("SOCORFID_PROBE_TIMEOUT", "0.5"))
+SONOS_HTTP_PORT = 1400
+
+_topology = {
+    "zones": set(),       # synlige SoCo-soner
+    "groups": {},         # uid -> ZoneGroup
+    "speakers": {},       # koordinatornavn -> koordinator-IP
+    "updated": None,      # time.time() for siste vellykkede oppdatering
+    "duration_ms": None,
+    "source": None,       # "unicast" | "ssdp" | "cache"
+    "refreshes": 0,
+    "error": None,
+}
+_topology_lock = threading.Lock()          # beskytter _topology
+_topology_refresh_lock = threading.Lock()  # kun én oppdatering om gangen
+_topology_wakeup = threading.Event()
+_topology_thread = None
+_topology_rediscover = False  # neste oppdatering fra tråden skal gjenoppdage
+_topology_changed = threading.Condition()  # varsles etter hver vellykkede oppdatering
+
+def _fetch_group_state(zone):
+    """
+    Les ZoneGroupState fra sonen og mat SoCos gruppecache med svaret. SoCos egen
+    poll() hopper over lesingen så lenge et ZoneGroupTopology-abonnement finnes,
+    så vi spør direkte for å få fersk tilstand uansett.
+    """
+    payload = zone.zoneGroupTopology.GetZoneGroupState()["ZoneGroupState"]
+    zgs = zone.zone_group_state
+    zgs.process_payload(payload, "poll", zone.ip_address)
+    return zgs
+
+def _read_groups(zones, fetch=True):
+    """
+    Én ZoneGroupTopology-lesing fra én sone gir alle grupper i huset.
+    fetch=False bruker det som allerede er lest (f.eks. av unicast-oppdagelsen).
+    Gruppene leses fra den tolkede tilstanden, så SoCo ikke spør på nytt.
+    """
+    groups = {}
+    if not zones:
+        return groups
+    zone = next(iter(zones))
+    zgs = _fetch_group_state(zone) if fetch else zone.zone_group_state
+    for grp in zgs.groups:
+        for m in grp.members:
+            groups[m.uid] = grp
+    return groups
+
+def _known_speaker_ips():
+    """IP-er vi allerede kjenner: device_mapping.json + forrige øyeblikksbilde."""
+    ips = set(load_mapping().values())
+    with _topology_lock:
+        ips.update(z.ip_address for z in _topology["zones"])
+        for grp in _topology["groups"].values():
+            ips.update(m.ip_address for m in grp.members)
+    valid = set()
+    for ip in ips:
+        try:
+            ipaddress.ip_address(ip)
+            valid.add(ip)
+        except (TypeError, ValueError):
+            continue
+    return valid
+
+def _probe_ip(ip, timeout):
+    try:
+        with socket.create_connection((ip, SONOS_HTTP_PORT), timeout=timeout):
+            return ip
+    except OSError:
+        return None
+
+def _unicast_discover(expected_uids):
+    """
+    Prob kjente IP-er parallelt og les ZoneGroupTopology fra første som svarer.
+    Returnerer None hvis ingen svarer eller en kjent sone mangler i svaret.
+    """
+    ips = _known_speaker_ips()
+    if not ips:
+        return None
+    pool = ThreadPoolExecutor(max_workers=min(16, len(ips)))
+    try:
+        futures = [pool.submit(_probe_ip, ip, UNICAST_PROBE_TIMEOUT) for ip in ips]
+        reachable = None
+        for fut in as_completed(futures):
+            reachable = fut.result()
+            if reachable:
+                break
+    finally:
+        pool.shutdown(wait=False)
+    if not reachable:
+        return None
+    zones = set(_fetch_group_state(SoCo(reachable)).visible_zones)
+    if not zones or expected_uids - {z.uid for z in zones}:
+        return None
+    return zones
+
+def _refresh_topology_locked(rediscover=True):
+    t0 = time.monotonic()
+    with _topology_lock:
+        zones = set(_topology["zones"])
+    source = "cache"
+    try:
+        if rediscover or not zones:
+            found = None
+            if UNICAST_REDISCOVERY:
+                try:
+                    found = _unicast_discover({z.uid for z in zones})
+                except Exception as e:
+                    print("Unicast-gjenoppdagelse feilet, faller tilbake til SSDP:", e)
+            if found:
+                source = "unicast"
+            else:
+                source = "ssdp"
+                found = discover(timeout=TOPOLOGY_DISCOVER_TIMEOUT) or set()
+            if not found and zones:
+                # Behold forrige øyeblikksbilde ved en tom SSDP-runde
+                raise RuntimeError("Fant ingen Sonos-enheter")
+            zones = found
+        # Unicast-oppdagelsen har nettopp lest gruppetilstanden; ikke spør igjen
+        groups = _read_groups(zones, fetch=source != "unicast")
+        speakers = {}
+        for z in zones:
             # Hvis enheten er del av en gruppe, bruk koordinatorens navn og IP
-            coordinator = device.group.coordinator
+            grp = groups.get(z.uid)
+            coordinator = grp.coordinator if grp else None
             if coordinator:
                 speakers[coordinator.player_name] = coordinator.ip_address
             else:
-                speakers[device.player_name] = device.ip_address
-    return speakers
+                speakers[z.player_name] = z.ip_address
+    except Exception as e:
+        with _topology_lock:
+            _topology["error"] = str(e)
+        raise
+    with _topology_lock:
+        _topology.update({
+            "zones": zones,
+            "groups": groups,
+            "speakers": speakers,
+            "updated": time.time(),
+            "duration_ms": int((time.monotonic() - t0) * 1000),
+            "source": source,
+            "refreshes": _topology["refreshes"] + 1,
+            "error": None,
+        })
+    with _topology_changed:
+        _topology_changed.notify_all()
+    if rediscover:
+        # Fersk oppdagelse: kast håndtak for høyttalere som er borte eller har byttet IP
+        ip_by_uid = {z.uid: z.ip_address for z in zones}
+        for grp in groups.values():
+            ip_by_uid.update({m.uid: m.ip_address for m in grp.members})
+        prune_speaker_handles(ip_by_uid)
+        sync_subscriptions(zones)
+
+def refresh_topology(rediscover=True):
+    """Oppdater cachen nå. rediscover=False gjenbruker kjente soner og leser kun grupper."""
+    with _topology_refresh_lock:
+        _refresh_topology_locked(rediscover)
+    return topology_snapshot()
+
+def topology_snapshot():
+    with _topology_lock:
+        updated = _topology["updated"]
+        return {
+            "zones": set(_topology["zones"]),
+            "groups": dict(_topology["groups"]),
+            "speakers": dict(_topology["speakers"]),
+            "updated": updated,
+            "age_s": round(time.time() - updated, 1) if updated else None,
+            "duration_ms": _topology["duration_ms"],
+            "source": _topology["source"],
+            "refreshes": _topology["refreshes"],
+            "error": _topology["error"],
+        }
+
+def get_topology(force=False):
+    """
+    Les topologien fra minnet. Tom cache (eller force=True) gir en synkron
+    oppdatering; feiler den, returneres forrige øyeblikksbilde hvis vi har et.
+    """
+    _ensure_topology_thread()
+    with _topology_refresh_lock:
+        with _topology_lock:
+            have = bool(_topology["zones"])
+        if force or not have:
+            try:
+                _refresh_topology_locked()
+            except Exception:
+                if not have:
+                    raise
+    return topology_snapshot()
+
+def request_topology_refresh(rediscover=True):
+    """Be bakgrunnstråden om en oppdatering uten å vente på den (rediscover=False: kun grupper)."""
+    global _topology_rediscover
+    _ensure_topology_thread()
+    if rediscover:
+        _topology_rediscover = True
+    _topology_wakeup.set()
+
+def _topology_worker():
+    global _topology_rediscover
+    while True:
+        if not _topology_wakeup.wait(TOPOLOGY_REFRESH_INTERVAL):
+            _topology_rediscover = True  # periodisk runde: full gjenoppdagelse
+        _topology_wakeup.clear()
+        rediscover, _topology_rediscover = _topology_rediscover, False
+        try:
+            refresh_topology(rediscover)
+        except Exception as e:
+            print("Feil ved oppdatering av topologi:", e)
+
+def _ensure_topology_thread():
+    global _topology_thread
+    with _topology_lock:
+        if _topology_thread is None:
+            _topology_thread = threading.Thread(target=_topology_worker, name="topology", daemon=True)
+            _topology_thread.start()
+
+def _topology_public(topo):
+    """JSON-vennlig utdrag av et øyeblikksbilde."""
+    groups = {}
+    for grp in topo["groups"].values():
+        if grp.uid in groups:
+            continue
+        groups[grp.uid] = {
+            "coordinator": grp.coordinator.player_name if grp.coordinator else None,
+            "members": sorted(m.player_name for m in grp.members if m in topo["zones"]),
+        }
+    return {
+        "updated": topo["updated"],
+        "age_s": topo["age_s"],
+        "duration_ms": topo["duration_ms"],
+        "source": topo["source"],
+        "refreshes": topo["refreshes"],
+        "error": topo["error"],
+        "speakers": topo["speakers"],
+        "groups": sorted(groups.values(), key=lambda g: g["coordinator"] or ""),
+    }
+
+def _wants_refresh():
+    return request.args.get("refresh", "").lower() in ("1", "true", "yes")
+
+GROUP_CONFIRM_TIMEOUT = 5.0
+
+def await_topology(predicate, timeout=GROUP_CONFIRM_TIMEOUT):
+    """
+    Vent til topologien oppfyller predicate. En oppdatering utløst av et
+    ZoneGroupTopology-event vekker oss med en gang; kommer ingen innen kort tid,
+    leses gruppene direkte fra en høyttaler. Predikatet sjekkes alltid mot en
+    nylig lest gruppetilstand. Returnerer (snapshot, bekreftet).
+    """
+    end = time.monotonic() + timeout
+    topo = topology_snapshot()
+    while True:
+        if predicate(topo):
+            return topo, True
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            return topo, False
+        with _topology_changed:
+            changed = _topology_changed.wait_for(
+                lambda: _topology["refreshes"] != topo["refreshes"], min(remaining, 0.3))
+        if changed:
+            topo = topology_snapshot()
+            continue
+        try:
+            topo = refresh_topology(rediscover=False)
+        except Exception as e:
+            print("Feil ved lesing av grupper:", e)
+            topo = topology_snapshot()
+
+def _visible_members(topo, grp):
+    """Gruppens synlige medlemmer; satellitter og andre halvdel av et stereopar telles ikke."""
+    visible = {z.uid for z in topo["zones"]}
+    return [m for m in grp.members if m.uid in visible] if grp else []
+
+def _join_soap(ip, coordinator_uid):
+    speaker_soap(ip, "avTransport", "SetAVTransportURI", [
+        ("InstanceID", 0), ("CurrentURI", f"x-rincon:{coordinator_uid}"), ("CurrentURIMetaData", ""),
+    ])
+
+def _unjoin_soap(ip):
+    speaker_soap(ip, "avTransport", "BecomeCoordinatorOfStandaloneGroup", [("InstanceID", 0)])
+
+def _run_parallel(calls):
+    """calls: [(player, fn, args)] -> feilliste. Alle kall sendes samtidig."""
+    futures = {_speaker_io_pool.submit(fn, *args): player for player, fn, args in calls}
+    errors = []
+    for fut in as_completed(futures):
+        try:
+            fut.result()
+        except Exception as e:
+            errors.append({"player": futures[fut].player_name, "error": str(e)})
+    return errors
+
+def discover_speakers(force=False):
+    return get_topology(force=force)["speakers"]
+
+# --------------------------
+# LIVE TILSTAND (UPnP-events)
+# AVTransport og RenderingControl abonneres per synlig sone, ZoneGroupTopology
+# på én sone for hele huset. Eventene holder en tilstandsmodell i minnet som
+# /play_pause, /players/status og forberedelse før avspilling leser fra i stedet
+# for å spørre høyttaleren. Abonnementene fornyes automatisk; feiler en fornyelse,
+# glemmes sonen og abonneres på nytt ved neste topologioppdatering.
+# --------------------------
+EVENTS_ENABLED = os.environ.get("SOCORFID_EVENTS", "1") != "0"
+EVENT_SUB_TIMEOUT = 600  # sekunder per abonnement (fornyes før utløp)
+
+_live = {}  # ip -> {"uid", "transport", "av_uri", "nr_tracks", "track_nr", "track", "volume", "muted", "updated", "subs"}
+_live_lock = threading.Lock()
+_topology_sub = None  # ZoneGroupTopology-abonnementet
+
+def _event_value(value):
+    """SoCoFault/None -> None, ellers verdien."""
+    return None if value is None or type(value).__name__ == "SoCoFault" else value
+
+def _on_av_event(ip, event):
+    v = event.variables
+    with _live_lock:
+        st = _live.get(ip)
+        if st is None:
+            return
+        if "transport_state" in v:
+            st["transport"] = v["transport_state"]
+        if "av_transport_uri" in v:
+            st["av_uri"] = v["av_transport_uri"] or ""
+        if "number_of_tracks" in v:
+            st["nr_tracks"] = int(v["number_of_tracks"] or 0)
+        if "current_track" in v:
+            st["track_nr"] = int(v["current_track"] or 0)
+        if "current_track_uri" in v or "current_track_meta_data" in v:
+            meta = _event_value(v.get("current_track_meta_data"))
+            st["track"] = {
+                "title": getattr(meta, "title", None),
+                "artist": getattr(meta, "creator", None),
+                "album": getattr(meta, "album", None),
+                "uri": v.get("current_track_uri", (st["track"] or {}).get("uri")),
+            }
+        st["updated"] = time.time()
+    invalidate_speaker_state(ip)
+
+def _on_rendering_event(ip, event):
+    v = event.variables
+    with _live_lock:
+        st = _live.get(ip)
+        if st is None:
+            return
+        if "volume" in v:
+            st["volume"] = int(v["volume"].get("Master", st["volume"] or 0))
+        if "mute" in v:
+            st["muted"] = v["mute"].get("Master") == "1"
+        st["updated"] = time.time()
+
+def _on_topology_event(event):
+    # SoCos trådbaserte event-lytter sender ikke ZoneGroupState videre til gruppecachen,
+    # og poll() leser ikke så lenge vi abonnerer: mat cachen med eventet selv
+    payload = event.variables.get("zone_group_state")
+    if payload:
+        zone = event.service.soco
+        try:
+            zone.zone_group_state.process_payload(payload, "event", zone.ip_address)
+        except Exception as e:
+            print("Kunne ikke lese ZoneGroupState fra event:", e)
+    # Gruppene er endret (eller første event etter abonnement): les grupper på nytt
+    request_topology_refresh(rediscover=False)
+
+def _attach(sub, callback):
+    sub.auto_renew_fail = lambda exc: _drop_live(sub.service.soco.ip_address)
+    sub.callback = callback
+    # Første event kan ha kommet før callback ble satt
+    while not sub.events.empty():
+        callback(sub.events.get_nowait())
+    return sub
+
+def _subscribe_zone(zone):
+    ip = zone.ip_address
+    subs = []
+    try:
+        subs.append(_attach(zone.avTransport.subscribe(requested_timeout=EVENT_SUB_TIMEOUT, auto_renew=True),
+                            lambda event: _on_av_event(ip, event)))
+        subs.append(_attach(zone.renderingControl.subscribe(requested_timeout=EVENT_SUB_TIMEOUT, auto_renew=True),
+                            lambda event: _on_rendering_event(ip, event)))
+    except Exception as e:
+        print(f"Kunne ikke abonnere på events fra {ip}:", e)
+        for sub in subs:
+            _unsubscribe(sub)
+        _drop_live(ip)
+        return
+    with _live_lock:
+        st = _live.get(ip)
+        if st is not None:
+            st["subs"] = subs
+
+def _unsubscribe(sub):
+    try:
+        sub.unsubscribe()
+    except Exception:
+        pass
+
+def _drop_live(ip):
+    with _live_lock:
+        st = _live.pop(ip, None)
+    if st:
+        for sub in st["subs"]:
+            _unsubscribe(sub)
+
+def _live_ready(st):
+    return (st["transport"] is not None and st["volume"] is not None
+            and len(st["subs"]) == 2 and all(sub.is_subscribed for sub in st["subs"]))
+
+def sync_subscriptions(zones):
+    """Abonner på nye soner, slipp forsvunne og utløpte. Kalles etter en topologi-gjenoppdagelse."""
+    global _topology_sub
+    if not EVENTS_ENABLED:
+        return
+    wanted = {z.ip_address: z for z in zones}
+    new = []
+    with _live_lock:
+        stale = [ip for ip, st in _live.items()
+                 if ip not in wanted or (st["subs"] and not all(s.is_subscribed for s in st["subs"]))]
+    for ip in stale:
+        _drop_live(ip)
+    with _live_lock:
+        for ip, zone in wanted.items():
+            if ip not in _live:
+                _live[ip] = {"uid": zone.uid, "transport": None, "av_uri": "", "nr_tracks": None,
+                             "track_nr": None, "track": None, "volume": None, "muted": None, "updated": None, "subs": []}
+                new.append(zone)
+    for zone in new:
+        _speaker_io_pool.submit(_subscribe_zone, zone)
+    if wanted and (_topology_sub is None or not _topology_sub.is_subscribed
+                   or _topology_sub.service.soco.ip_address not in wanted):
+        if _topology_sub is not None:
+            _unsubscribe(_topology_sub)
+            _topology_sub = None
+        try:
+            zone = next(iter(wanted.values()))
+            sub = zone.zoneGroupTopology.subscribe(requested_timeout=EVENT_SUB_TIMEOUT, auto_renew=True)
+            sub.callback = _on_topology_event
+            _topology_sub = sub
+        except Exception as e:
+            print("Kunne ikke abonnere på ZoneGroupTopology:", e)
+
+def live_state(ip):
+    """Tilstanden fra events for IP-en, eller None hvis vi ikke har et levende abonnement."""
+    with _live_lock:
+        st = _live.get(ip)
+        if st is None or not _live_ready(st):
+            return None
+        return {k: v for k, v in st.items() if k != "subs"}
+
+def live_stats():
+    with _live_lock:
+        return {
+            "enabled": EVENTS_ENABLED,
+            "speakers": len(_live),
+            "live": sum(1 for st in _live.values() if _live_ready(st)),
+            "topology_subscribed": bool(_topology_sub and _topology_sub.is_subscribed),
+        }
 
 @app.route("/speakers", methods=["GET"])
 @require_auth_or_local
 def get_speakers_endpoint():
-    speakers = discover_speakers()
+    speakers = discover_speakers(force=_wants_refresh())
     return jsonify(speakers)
 
+@app.route("/topology", methods=["GET"])
+@require_auth_or_local
+def get_topology_endpoint():
+    try:
+        return jsonify(_topology_public(get_topology(force=_wants_refresh())))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/topology/refresh", methods=["POST"])
+@require_auth_or_local
+def refresh_topology_endpoint():
+    try:
+        return jsonify(_topology_public(refresh_topology()))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/set_speaker", methods=["POST"])
 @require_auth_or_local
 def set_speaker_endpoint():
@@ -582,11 +3076,28 @@ def set_speaker_endpoint():
         return jsonify({"error": "Mangler speaker/ip"}), 400
 
     set_speaker_for_device(device_id, chosen_ip)
+    warm_speaker(chosen_ip)
     return jsonify({"status": "Høyttaler oppdatert", "device_id": device_id, "ip": chosen_ip})
 
 # --------------------------
 # ROUTER SOM DELEGERER TIL SERVICE-LAG
 # --------------------------
+ASYNC_PLAY_DEFAULT = os.environ.get("SOCORFID_ASYNC_PLAY", "0") == "1"
+
+def _wants_async(data):
+    flag = data.get("async", request.args.get("async"))
+    if flag is None:
+        return ASYNC_PLAY_DEFAULT
+    return str(flag).lower() in ("1", "true", "yes")
+
+def _play_response(data, kind, device_id, fn, *args, **kwargs):
+    """Kjør fn synkront, eller som jobb (202 + jobb-id) når klienten ber om async."""
+    if _wants_async(data):
+        job = submit_job(kind, device_id, fn, *args, **kwargs)
+        return jsonify({"status": "Mottatt", "job_id": job["id"], "job_url": f"/jobs/{job['id']}"}), 202
+    body, code = fn(*args, **kwargs)
+    return jsonify(body), code
+
 @app.route("/play/playlink", methods=["POST"])
 @require_auth_or_local
 def play_playlink():
@@ -597,8 +3108,7 @@ def play_playlink():
         return jsonify({"error": "device_id mangler"}), 400
     if not media:
         return jsonify({"error": "media (Spotify-playlink) mangler"}), 400
-    body, code = svc_play_playlink(device_id, media)
-    return jsonify(body), code
+    return _play_response(data, "playlink", device_id, svc_play_playlink, device_id, media)
 
 @app.route("/play/nrk_program", methods=["POST"])
 @require_auth_or_local
@@ -610,8 +3120,8 @@ def play_nrk_program():
         return jsonify({"error": "device_id mangler"}), 400
     if not media:
         return jsonify({"error": "media (NRK-URL) mangler i request"}), 400
-    body, code = svc_play_nrk_program(device_id, media)
-    return jsonify(body), code
+    return _play_response(data, "nrk_program", device_id, svc_play_nrk_program, device_id, media,
+                          fast_start=data.get("fast_start"), lazy=data.get("lazy"))
 
 @app.route("/play/nrk_podcast", methods=["POST"])
 @require_auth_or_local
@@ -623,8 +3133,8 @@ def play_nrk_podcast():
         return jsonify({"error": "device_id mangler"}), 400
     if not media:
         return jsonify({"error": "media (XML-filnavn ELLER episode-URL) mangler i request"}), 400
-    body, code = svc_play_nrk_podcast(device_id, media)
-    return jsonify(body), code
+    return _play_response(data, "nrk_podcast", device_id, svc_play_nrk_podcast, device_id, media,
+                          fast_start=data.get("fast_start"), lazy=data.get("lazy"))
 
 @app.route("/play/stream", methods=["POST"])
 @require_auth_or_local
@@ -634,8 +3144,24 @@ def play_stream():
     uri = data.get("uri")
     if not device_id or not uri:
         return jsonify({"error": "device_id/uri mangler"}), 400
-    body, code = svc_play_stream(device_id, uri)
-    return jsonify(body), code
+    return _play_response(data, "stream", device_id, svc_play_stream, device_id, uri)
+
+@app.route("/jobs", methods=["GET"])
+@require_auth_or_local
+def list_jobs():
+    return jsonify({"jobs": jobs_overview()})
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+@require_auth_or_local
+def get_job_endpoint(job_id):
+    try:
+        wait = float(request.args.get("wait", 0))
+    except ValueError:
+        return jsonify({"error": "wait må være et tall"}), 400
+    job = get_job(job_id, wait=wait)
+    if job is None:
+        return jsonify({"error": "Ukjent eller utløpt jobb"}), 404
+    return jsonify(job)
 
 # --------------------------
 # QUEUE / NAV / CONTROL
@@ -650,7 +3176,7 @@ def get_queue():
     if not speaker_ip:
         return jsonify({"error": "Ingen høyttaler valgt for denne device_id"}), 400
     try:
-        sonos = SoCo(speaker_ip)
+        sonos = get_sonos(speaker_ip)
         queue = sonos.get_queue()
         result = []
         if not queue:
@@ -665,6 +3191,20 @@ def get_queue():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route("/queue/fill", methods=["GET"])
+@require_auth_or_local
+def get_queue_fill():
+    device_id = request.args.get("device_id")
+    if not device_id:
+        return jsonify({"error": "device_id mangler"}), 400
+    speaker_ip = get_speaker_for_device(device_id)
+    if not speaker_ip:
+        return jsonify({"error": "Ingen høyttaler valgt for denne device_id"}), 400
+    fill = queue_fill_status(speaker_ip)
+    if fill is None:
+        return jsonify({"error": "Ingen påfylling registrert for denne høyttaleren"}), 404
+    return jsonify(fill)
+
 @app.route("/play_by_card", methods=["POST"])
 @require_auth_or_local
 def play_by_card():
@@ -676,30 +3216,14 @@ def play_by_card():
     if not card_id:
         return jsonify({"error": "card_id mangler"}), 400
 
-    with open("rfid_mappings.json", "r") as f:
-        mapping_data = json.load(f)
-
-    if card_id not in mapping_data:
-        with open("last_unmapped_rfid.txt", "w") as f:
-            f.write(card_id)
+    mapping = get_card(card_id)
+    if mapping is None:
+        db_record_unmapped(card_id, device_id)
         return jsonify({"error": "RFID ikke funnet, lagret som siste udefinerte RFID"}), 404
-
-    mapping = mapping_data[card_id]
-    mapping_type = mapping.get("type")
-    media = mapping.get("media")
-
-    if mapping_type == "program":
-        body, code = svc_play_nrk_program(device_id, media)
-    elif mapping_type == "podcast":
-        body, code = svc_play_nrk_podcast(device_id, media)
-    elif mapping_type == "playlink":
-        body, code = svc_play_playlink(device_id, media)
-    elif mapping_type == "stream":
-        body, code = svc_play_stream(device_id, media)
-    else:
+    if mapping.get("type") not in CARD_TYPES:
         return jsonify({"error": "Ukjent mapping-type"}), 400
 
-    return jsonify(body), code
+    return _play_response(data, "play_by_card", device_id, svc_play_card, device_id, card_id, mapping, data)
 
 @app.route("/add_mapping", methods=["POST"])
 @require_auth_or_local
@@ -711,28 +3235,10 @@ def add_mapping():
     if not card_id or not mapping_type or not media:
         return jsonify({"error": "Følgende felt må være med: card_id, type og media"}), 400
 
-    mapping_data = {"type": mapping_type, "media": media}
     try:
-        try:
-            with open("rfid_mappings.json", "r") as f:
-                mappings = json.load(f)
-        except FileNotFoundError:
-            mappings = {}
-        mappings[card_id] = mapping_data
-        with open("rfid_mappings.json", "w") as f:
-            json.dump(mappings, f, indent=4)
-        
-        # Hvis lagringen av mapping var vellykket, tøm last_unmapped_rfid.txt
-        try:
-            with open("last_unmapped_rfid.txt", "r+") as f:
-                current = f.read().strip()
-                # Slett bare hvis innholdet stemmer overens med card_id vi nettopp lagret
-                if current == card_id:
-                    f.seek(0)
-                    f.truncate()
-        except Exception as e:
-            print("Feil ved tømming av last_unmapped_rfid.txt:", e)
-        
+        # Én rad upsertes; /last-rfid slutter å vise kortet når det har fått mapping
+        db_upsert_card(card_id, mapping_type, media)
+        request_plan_rebuild()
         return jsonify({"status": "Mapping lagt til", "card_id": card_id})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -748,8 +3254,8 @@ def next_track():
     if not speaker_ip:
         return jsonify({"error": "Ingen høyttaler valgt for denne device_id"}), 400
     try:
-        sonos = SoCo(speaker_ip)
-        sonos.next()
+        speaker_soap(speaker_ip, "avTransport", "Next", [("InstanceID", 0), ("Speed", 1)])
+        invalidate_speaker_state(speaker_ip)
         return jsonify({"status": "Next track command sent"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -759,6 +3265,18 @@ def next_track():
 def status():
     return "OK", 200
 
+@app.route("/stats", methods=["GET"])
+@require_auth_or_local
+def stats():
+    return jsonify({
+        "card_index": card_index_stats(),
+        "nrk_metadata": nrk_metadata_stats(),
+        "http": http_stats(),
+        "stream_cache": stream_cache_stats(),
+        "speakers": speaker_handle_stats(),
+        "events": live_stats(),
+    })
+
 @app.route("/play_pause", methods=["POST"])
 @require_auth_or_local
 def play_pause():
@@ -772,14 +3290,19 @@ def play_pause():
         return jsonify({"error": "Ingen høyttaler valgt for denne device_id"}), 400
 
     try:
-        sonos = SoCo(speaker_ip)
-        state = sonos.get_current_transport_info().get('current_transport_state')
+        live = live_state(speaker_ip)
+        if live:
+            state = live["transport"]  # fra events; slipper en lese-rundtur
+        else:
+            info = speaker_soap(speaker_ip, "avTransport", "GetTransportInfo", [("InstanceID", 0)])
+            state = info.get('CurrentTransportState')
         if state == 'PLAYING':
-            sonos.pause()
+            speaker_soap(speaker_ip, "avTransport", "Pause", [("InstanceID", 0), ("Speed", 1)])
             action = 'paused'
         else:
-            sonos.play()
+            speaker_soap(speaker_ip, "avTransport", "Play", [("InstanceID", 0), ("Speed", 1)])
             action = 'playing'
+        invalidate_speaker_state(speaker_ip)
         return jsonify({"status": f"Toggled play/pause ({action})"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -797,8 +3320,8 @@ def previous_track():
         return jsonify({"error": "Ingen høyttaler valgt for denne device_id"}), 400
 
     try:
-        sonos = SoCo(speaker_ip)
-        sonos.previous()
+        speaker_soap(speaker_ip, "avTransport", "Previous", [("InstanceID", 0), ("Speed", 1)])
+        invalidate_speaker_state(speaker_ip)
         return jsonify({"status": "Previous track command sent"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -806,9 +3329,44 @@ def previous_track():
 @app.route("/mappings", methods=["GET"])
 @require_auth_or_local
 def get_mappings():
-    with open("rfid_mappings.json") as f:
-        data = json.load(f)
-    return jsonify(data)
+    return jsonify(all_cards())
+
+@app.route("/plans", methods=["GET"])
+@require_auth_or_local
+def get_card_plans():
+    _ensure_plan_thread()
+    return jsonify({"plans": card_plans_status(), "refresh_interval_s": PLAN_REFRESH_INTERVAL})
+
+@app.route("/plans/rebuild", methods=["POST"])
+@require_auth_or_local
+def rebuild_card_plan_endpoint():
+    data = request.json or {}
+    card_id = data.get("card_id")
+    if not card_id:
+        return jsonify({"error": "card_id mangler"}), 400
+    mapping = get_card(card_id)
+    if mapping is None:
+        return jsonify({"error": "Ukjent kort"}), 404
+    if mapping.get("type") not in PLAN_TYPES:
+        return jsonify({"error": f"Ingen plan for mapping-type {mapping.get('type')}"}), 400
+    plan = rebuild_card_plan(card_id, mapping)
+    return jsonify(_plan_public(card_id, plan)), (500 if plan["error"] else 200)
+
+@app.route("/playlists", methods=["GET"])
+@require_auth_or_local
+def get_card_playlists():
+    body, code = svc_card_playlists(request.args.get("device_id"))
+    return jsonify(body), code
+
+@app.route("/playlists/gc", methods=["POST"])
+@require_auth_or_local
+def collect_card_playlists():
+    data = request.get_json(silent=True) or {}
+    destroy = data.get("destroy") or []
+    if isinstance(destroy, str):
+        destroy = [destroy]
+    body, code = svc_card_playlists(data.get("device_id"), collect=True, destroy=destroy)
+    return jsonify(body), code
 
 # --------------------------
 # SONOS: UNGROUP (splitter alle grupper)
@@ -817,26 +3375,36 @@ def get_mappings():
 @require_auth_or_local
 def ungroup_all():
     try:
-        zones = discover(timeout=3) or set()
+        # Ett øyeblikksbilde: kun medlemmer (ikke koordinatorer) trenger å forlate gruppen
+        t0 = time.monotonic()
+        topo = refresh_topology(rediscover=False)
+        zones = topo["zones"]
         ungrouped = []
         already_solo = []
-        errors = []
+        calls = []
 
         for z in zones:
-            try:
-                grp = z.group
-                if grp and len(grp.members) > 1:
-                    z.unjoin()
-                    ungrouped.append(z.player_name)
-                else:
-                    already_solo.append(z.player_name)
-            except Exception as e:
-                errors.append({"player": getattr(z, "player_name", "ukjent"), "error": str(e)})
+            grp = topo["groups"].get(z.uid)
+            if len(_visible_members(topo, grp)) > 1:
+                ungrouped.append(z.player_name)
+                if not (grp.coordinator and grp.coordinator.uid == z.uid):
+                    calls.append((z, _unjoin_soap, (z.ip_address,)))
+            else:
+                already_solo.append(z.player_name)
+
+        errors = _run_parallel(calls)
+        confirmed = True
+        if calls:
+            uids = {z.uid for z in zones}
+            _, confirmed = await_topology(lambda t: all(
+                len(_visible_members(t, t["groups"][uid])) == 1 for uid in uids if uid in t["groups"]))
 
         return jsonify({
             "found": len(zones),
             "ungrouped": sorted(ungrouped),
             "already_solo": sorted(already_solo),
+            "confirmed": confirmed,
+            "elapsed_ms": int((time.monotonic() - t0) * 1000),
             "errors": errors
         })
     except Exception as e:
@@ -864,7 +3432,11 @@ def group_speakers():
     exact = bool(data.get("exact", False))
     device_id = data.get("device_id")
 
-    zones = discover(timeout=3) or set()
+    try:
+        topo = refresh_topology(rediscover=False)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    zones = topo["zones"]
     if not zones:
         return jsonify({"error": "Fant ingen Sonos-enheter"}), 500
 
@@ -902,43 +3474,57 @@ def group_speakers():
         return jsonify({"error": "Koordinator må være blant 'speakers' og være entydig"}), 400
 
     wanted_set = {z.uid for z in resolved}
-    errors, added, already = [], [], []
-
-    # Join alle ønskede inn i koordinators gruppe
+    errors, added, already, removed = [], [], [], []
+    t0 = time.monotonic()
+
+    # Diff mot ett øyeblikksbilde; ingen ny topologilesing mellom kallene
+    coord_grp = topo["groups"].get(coord.uid)
+    coord_leads = not coord_grp or (coord_grp.coordinator and coord_grp.coordinator.uid == coord.uid)
+    if not coord_leads:
+        # Koordinatoren er medlem i en annen gruppe: gjør den selvstendig først
+        errors += _run_parallel([(coord, _unjoin_soap, (coord.ip_address,))])
+        coord_grp = None
+
+    calls = []
     for z in resolved:
         if z.uid == coord.uid:
             continue
-        try:
-            if z.group and z.group.coordinator.uid == coord.uid:
-                already.append(z.player_name)
-            else:
-                z.join(coord)
-                added.append(z.player_name)
-        except Exception as e:
-            errors.append({"player": z.player_name, "error": str(e)})
-
-    removed = []
+        grp = topo["groups"].get(z.uid)
+        if coord_leads and grp and grp.coordinator and grp.coordinator.uid == coord.uid:
+            already.append(z.player_name)
+        else:
+            added.append(z.player_name)
+            calls.append((z, _join_soap, (z.ip_address, coord.uid)))
     # exact=True: fjern alle andre som ligger i koordinators gruppe, men ikke står på lista
-    try:
-        grp = coord.group
-        if exact and grp:
-            for m in list(grp.members):
-                if m.uid == coord.uid:
-                    continue
-                if m.uid not in wanted_set:
-                    try:
-                        m.unjoin()
-                        removed.append(m.player_name)
-                    except Exception as e:
-                        errors.append({"player": m.player_name, "error": str(e)})
-    except Exception as e:
-        errors.append({"stage": "exact_prune", "error": str(e)})
+    if exact and coord_grp:
+        for m in _visible_members(topo, coord_grp):
+            if m.uid != coord.uid and m.uid not in wanted_set:
+                removed.append(m.player_name)
+                calls.append((m, _unjoin_soap, (m.ip_address,)))
+
+    # Alle join/unjoin samtidig, deretter vent på at topologien bekrefter resultatet
+    errors += _run_parallel(calls)
+    failed = {e["player"] for e in errors if "player" in e}
+    added = [n for n in added if n not in failed]
+    removed = [n for n in removed if n not in failed]
+
+    def settled(t):
+        grp = t["groups"].get(coord.uid)
+        if not grp:
+            return False
+        uids = {m.uid for m in _visible_members(t, grp) if m.player_name not in failed}
+        want = {z.uid for z in resolved if z.player_name not in failed}
+        return want <= uids and (not exact or uids <= wanted_set)
+
+    confirmed = True
+    if calls or not coord_leads:
+        topo, confirmed = await_topology(settled)
 
     # Rapporter endelig gruppesammensetning + koordinatorinfo
     members_info = []
     try:
-        grp = coord.group
-        members = grp.members if grp else [coord]
+        grp = topo["groups"].get(coord.uid)
+        members = _visible_members(topo, grp) or [coord]
         for m in members:
             members_info.append({"name": m.player_name, "ip": m.ip_address, "uid": m.uid})
     except Exception:
@@ -965,64 +3551,147 @@ def group_speakers():
         "final_group": [m["name"] for m in members_info],
         "members": members_info,
         "mapped_device_id": mapped_device_id,
+        "confirmed": confirmed,
+        "elapsed_ms": int((time.monotonic() - t0) * 1000),
         "errors": errors
     })
 
 # --------------------------
 # SONOS: STATUS FOR ALLE HØYTTALERE
 # --------------------------
+# Soner spørres parallelt med en frist per høyttaler; de som ikke svarer i tide
+# rapporteres med det vi vet fra topologien og "partial": true. fields= begrenser
+# hvilke kall som gjøres (f.eks. ?fields=state,volume).
+PLAYER_STATUS_DEADLINE = float(os.environ.get("SOCORFID_STATUS_DEADLINE", "2.0"))
+PLAYER_STATUS_FIELDS = ("state", "track", "volume", "muted", "group")
+_status_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="player-status")
+
+_DC = "{http://purl.org/dc/elements/1.1/}"
+_UPNP = "{urn:schemas-upnp-org:metadata-1-0/upnp/}"
+_RADIO = "{urn:schemas-rinconnetworks-com:metadata-1-0/}"
+
+def _track_from_position(info):
+    """Tittel, artist og album fra GetPositionInfo sin TrackMetaData."""
+    track = {"title": None, "artist": None, "album": None,
+             "position": info.get("RelTime"), "uri": info.get("TrackURI")}
+    meta = info.get("TrackMetaData") or ""
+    if meta in ("", "NOT_IMPLEMENTED"):
+        return track
+    try:
+        item = ET.fromstring(meta)
+    except ET.ParseError:
+        return track
+    track["title"] = item.findtext(f".//{_DC}title")
+    track["artist"] = item.findtext(f".//{_DC}creator")
+    track["album"] = item.findtext(f".//{_UPNP}album")
+    stream = item.findtext(f".//{_RADIO}streamContent")
+    if stream and not track["artist"]:
+        # Radio: "Artist - Tittel" i streamContent
+        artist, sep, title = stream.partition(" - ")
+        track.update({"artist": artist, "title": title} if sep else {"title": stream})
+    return track
+
+def _zone_status(z, fields, end):
+    """
+    Feltene som krever kall mot høyttaleren (eller kommer fra events).
+    end er fristen (time.monotonic()); hvert kall får bare tiden som er igjen,
+    så en høyttaler som henger ikke holder en arbeider lenger enn fristen.
+    """
+    result = {}
+    live = live_state(z.ip_address)
+    if live:
+        result["source"] = "events"
+        state = live["transport"]
+        if "state" in fields:
+            result["state"] = state
+        if "track" in fields:
+            track = None
+            if state in ("PLAYING", "PAUSED_PLAYBACK") and live["track"]:
+                track = {**live["track"], "position": None}  # posisjon events ikke
+            result["track"] = track
+        if "volume" in fields:
+            result["volume"] = live["volume"]
+        if "muted" in fields:
+            result["muted"] = bool(live["muted"])
+        return result
+
+    def soap(service, action, args):
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Fristen er ute")
+        return speaker_soap(z.ip_address, service, action, args, timeout=remaining)
+
+    result["source"] = "poll"
+    if "state" in fields or "track" in fields:
+        info = soap("avTransport", "GetTransportInfo", [("InstanceID", 0)])
+        state = info.get("CurrentTransportState") or "UNKNOWN"
+        if "state" in fields:
+            result["state"] = state                     # PLAYING / PAUSED_PLAYBACK / STOPPED / etc.
+        if "track" in fields:
+            track = None
+            if state in ("PLAYING", "PAUSED_PLAYBACK"):
+                track = _track_from_position(soap("avTransport", "GetPositionInfo", [("InstanceID", 0)]))
+            result["track"] = track
+    if "volume" in fields:
+        info = soap("renderingControl", "GetVolume", [("InstanceID", 0), ("Channel", "Master")])
+        result["volume"] = int(info.get("CurrentVolume") or 0)
+    if "muted" in fields:
+        info = soap("renderingControl", "GetMute", [("InstanceID", 0), ("Channel", "Master")])
+        result["muted"] = info.get("CurrentMute") == "1"
+    return result
+
 @app.route("/players/status", methods=["GET"])
 @require_auth_or_local
 def players_status():
+    fields = set(PLAYER_STATUS_FIELDS)
+    if request.args.get("fields"):
+        fields = {f.strip() for f in request.args["fields"].split(",") if f.strip()}
+        unknown = fields - set(PLAYER_STATUS_FIELDS)
+        if unknown:
+            return jsonify({"error": f"Ukjente felt: {', '.join(sorted(unknown))}",
+                            "fields": list(PLAYER_STATUS_FIELDS)}), 400
+    try:
+        deadline = min(float(request.args.get("timeout", PLAYER_STATUS_DEADLINE)), 10.0)
+    except ValueError:
+        return jsonify({"error": "timeout må være et tall"}), 400
+
     try:
-        zones = discover(timeout=3) or set()
+        topo = get_topology()
+        zones = topo["zones"]
         players = []
+        pending = {}
+        end = time.monotonic() + deadline
 
         for z in zones:
-            try:
-                info = z.get_current_transport_info() or {}
-                state = info.get("current_transport_state") or "UNKNOWN"
-
-                track = None
-                if state in ("PLAYING", "PAUSED_PLAYBACK"):
-                    t = z.get_current_track_info() or {}
-                    track = {
-                        "title": t.get("title"),
-                        "artist": t.get("artist"),
-                        "album": t.get("album"),
-                        "position": t.get("position"),
-                        "uri": t.get("uri"),
-                    }
-
-                grp = z.group
+            # Navn, IP og gruppe kommer fra topologi-cachen uten nettverkskall
+            player = {"name": z.player_name, "ip": z.ip_address}
+            grp = topo["groups"].get(z.uid)
+            is_coord = bool(grp and grp.coordinator and grp.coordinator.uid == z.uid)
+            player["is_coordinator"] = is_coord
+            if "group" in fields:
                 group_data = None
-                is_coord = False
                 if grp:
-                    is_coord = grp.coordinator and grp.coordinator.uid == z.uid
                     group_data = {
                         "coordinator": grp.coordinator.player_name if grp.coordinator else None,
                         "members": [m.player_name for m in grp.members],
                     }
+                player["group"] = group_data
+            players.append(player)
+            if fields - {"group"}:
+                pending[_status_pool.submit(_zone_status, z, fields, end)] = player
 
-                players.append({
-                    "name": z.player_name,
-                    "ip": z.ip_address,
-                    "state": state,                     # PLAYING / PAUSED_PLAYBACK / STOPPED / etc.
-                    "volume": z.volume,
-                    "muted": bool(z.mute),
-                    "is_coordinator": bool(is_coord),
-                    "group": group_data,
-                    "track": track,
-                })
+        done, not_done = wait(pending, timeout=max(0, end - time.monotonic()))
+        for fut in done:
+            try:
+                pending[fut].update(fut.result())
             except Exception as e:
-                players.append({
-                    "name": getattr(z, "player_name", "ukjent"),
-                    "ip": getattr(z, "ip_address", None),
-                    "error": str(e),
-                })
+                pending[fut]["error"] = str(e)
+        for fut in not_done:
+            fut.cancel()
+            pending[fut].update({"partial": True, "error": f"Svarte ikke innen {deadline:g} s"})
 
         players.sort(key=lambda p: p.get("name") or "")
-        return jsonify({"found": len(zones), "players": players})
+        return jsonify({"found": len(zones), "partial": len(not_done), "players": players})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -1030,4 +3699,8 @@ def players_status():
 # MAIN
 # --------------------------
 if __name__ == "__main__":
+    # SIGTERM (systemd/docker) -> SystemExit, slik at atexit-flush rekker å kjøre
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    _ensure_plan_thread()
+    request_topology_refresh()  # første oppdagelse nå, ikke ved første /speakers
     app.run(host="0.0.0.0", port=5000)